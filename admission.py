@@ -0,0 +1,152 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Match
+from fastapi.routing import APIRoute
+import metrics
+
+# Requests that can be running at once, each makes a handful of Firestore round trips. 0 turns the limiter off.
+ADMISSION_CONCURRENCY = int(os.environ.get('ADMISSION_CONCURRENCY', 64))
+
+# Seconds a request waits for a free slot before it is turned away
+ADMISSION_MAX_WAIT = float(os.environ.get('ADMISSION_MAX_WAIT', 0.5))
+
+# Requests that can be waiting at once, beyond that requests are turned away without waiting
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', 256))
+
+# Seconds clients are asked to wait before trying again
+RETRY_AFTER_SECONDS = 1
+
+# Priorities of the requests, waiting requests are admitted lowest number first
+PRIORITIES = {'write': 0, 'default': 1, 'list': 2}
+
+# Routes that don't make the default priority, by method and route template
+ROUTE_PRIORITIES = {
+    ('POST', '/book-room'): 'write',
+    ('GET', '/edit-booking'): 'write',
+    ('POST', '/edit-booking'): 'write',
+    ('POST', '/delete-booking'): 'write',
+    ('POST', '/api/v1/rooms/{room}/bookings'): 'write',
+    ('DELETE', '/api/v1/rooms/{room}/bookings/{date}/{start}'): 'write',
+    ('GET', '/view-bookings'): 'list',
+    ('POST', '/view-bookings'): 'list',
+    ('GET', '/view-room/{room}'): 'list',
+    ('GET', '/api/v1/rooms'): 'list',
+    ('GET', '/api/v1/rooms/{room}/bookings'): 'list',
+    ('GET', '/api/v1/rooms/{room}/stats'): 'list',
+    ('GET', '/api/v1/me/bookings'): 'list',
+    ('GET', '/api/v1/availability'): 'list',
+    ('GET', '/api/v1/export/bookings'): 'list',
+    ('GET', '/api/v1/export/rooms/{room}/bookings'): 'list',
+    ('GET', '/api/v1/export/me/bookings'): 'list',
+}
+
+# Routes that are never limited, the metrics have to stay up under load and event streams stay open for as long as the page
+EXEMPT_ROUTES = {'/metrics', '/booking-metrics', '/live/rooms', '/live/rooms/{room}'}
+
+class Overloaded(Exception):
+    """Raised when a request can't be admitted, because the queue is full or it waited too long."""
+
+class AdmissionQueue:
+    """Limits the requests running at once, the others wait in a queue ordered by priority then arrival.
+
+    A request waits at most `max_wait` seconds. When the queue is full a request is turned away right
+    away, unless the queue holds a request of lower priority, which is then turned away in its place.
+    Runs on the event loop only.
+    """
+
+    def __init__(self, limit, max_wait, queue_size):
+        self.limit = limit
+        self.max_wait = max_wait
+        self.queue_size = queue_size
+        self.running = 0
+        self.queued = 0
+        self._waiting = []
+        self._order = itertools.count()
+
+    async def acquire(self, priority):
+        if self.running < self.limit and not self.queued:
+            self.running += 1
+            metrics.ADMISSION_RUNNING.set(self.running)
+            return
+        if self.queued >= self.queue_size:
+            self._shedLowest(PRIORITIES[priority])
+        entry = (PRIORITIES[priority], next(self._order), asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiting, entry)
+        self.queued += 1
+        metrics.ADMISSION_QUEUED.labels(priority).inc()
+        try:
+            # the slot is handed over by release(), with `running` already counting it
+            await asyncio.wait_for(entry[2], self.max_wait)
+        except asyncio.TimeoutError:
+            raise Overloaded('timeout')
+        except asyncio.CancelledError:
+            # the client went away, after the slot may have been handed over
+            if entry[2].done() and not entry[2].cancelled() and entry[2].exception() is None:
+                self.release()
+            raise
+        finally:
+            self.queued -= 1
+            metrics.ADMISSION_QUEUED.labels(priority).dec()
+
+    def release(self):
+        while self._waiting:
+            entry = heapq.heappop(self._waiting)
+            if not entry[2].done():
+                entry[2].set_result(None)
+                return
+        self.running -= 1
+        metrics.ADMISSION_RUNNING.set(self.running)
+
+    # Function to make room in a full queue by turning away the newest waiting request of a lower priority than `priority`
+    def _shedLowest(self, priority):
+        waiting = [entry for entry in self._waiting if not entry[2].done() and entry[0] > priority]
+        if not waiting:
+            raise Overloaded('queue full')
+        max(waiting)[2].set_exception(Overloaded('queue full'))
+
+admission_queue = AdmissionQueue(ADMISSION_CONCURRENCY, ADMISSION_MAX_WAIT, ADMISSION_QUEUE_SIZE)
+
+# Function to find the route a request will be handled by, the router only sets it in the scope once the request gets to it
+def _matchRoute(request):
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route
+    return None
+
+# Function to answer a request that was turned away, in JSON for the API like its other errors
+def _overloadedResponse(request):
+    headers = {'Retry-After': str(RETRY_AFTER_SECONDS)}
+    if request.url.path.startswith('/api/'):
+        return JSONResponse({'detail': 'The service is busy right now, please try again'}, status_code=503, headers=headers)
+    return PlainTextResponse('The service is busy right now, please try again', status_code=503, headers=headers)
+
+# Middleware admitting requests through the admission queue, by the priority of their route. Requests for static files,
+# metrics, event streams and unknown paths don't read Firestore and skip the queue.
+async def admitRequest(request, call_next):
+    route = _matchRoute(request)
+    if ADMISSION_CONCURRENCY <= 0 or not isinstance(route, APIRoute) or route.path in EXEMPT_ROUTES:
+        return await call_next(request)
+
+    priority = ROUTE_PRIORITIES.get((request.method, route.path), 'default')
+    started = time.perf_counter()
+    try:
+        await admission_queue.acquire(priority)
+    except Overloaded as err:
+        # the instrumenting middleware records the response under this route
+        request.scope['route'] = route
+        metrics.ADMISSION_SHED.labels(route.path, str(err)).inc()
+        return _overloadedResponse(request)
+    finally:
+        metrics.recordQueueWait(priority, time.perf_counter() - started)
+    try:
+        response = await call_next(request)
+    except BaseException:
+        admission_queue.release()
+        raise
+    # the slot is held until the body has been sent, the exports read their pages from Firestore while it streams
+    return metrics.afterBody(response, admission_queue.release)
@@ -0,0 +1,246 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+import starlette.status as status
+import datetime
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+from database import firestore_db, bookingIndex, roomBookingsQuery
+from catalog import room_catalog
+from auth import getUserToken, getCurrentUser
+from booking import validateBooking, createBooking, createRecurringBooking, cancelBooking, RoomNotFound, BookingConflict, RecurringConflict, InvalidRecurrence, BookingAborted
+from intervals import DAY_START, DAY_END, toMinutes, isTime, isDate
+from availability import MINUTES_PER_DAY, findAvailableRooms
+from bulkimport import importBookings
+from roomdeletion import startRoomDeletion, getRoomDeletion, RoomHasBookings, RoomDeletionAborted
+from roomstats import MAX_STATS_DAYS, getRoomStats
+import export
+
+# JSON API for dashboards and displays. Lists are paged with Firestore query cursors: every page has a
+# `next` cursor that is passed back as `start_after` to get the following page, and `fields` restricts
+# the fields that are returned. Starlette already renders JSON without any whitespace.
+router = APIRouter(prefix='/api/v1', dependencies=[Depends(getUserToken)])
+
+MAX_PAGE_SIZE = 500
+
+class BookingIn(BaseModel):
+    name: str
+    date: str
+    start: str = Field(alias='from')
+    end: str = Field(alias='to')
+    # optional recurrence: 'daily' or 'weekly', every `interval` days or weeks until the `until` date
+    repeat: str | None = None
+    interval: int = 1
+    until: str | None = None
+
+# Function to split the `fields` query parameter into a list of field names
+def _fields(fields):
+    return [field.strip() for field in fields.split(',') if field.strip()] if fields else None
+
+def _project(data, fields):
+    return {key: value for key, value in data.items() if key in fields} if fields else data
+
+def _room(name):
+    room = room_catalog.get(name)
+    if room is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "The selected room is no longer available")
+    return room
+
+# Function to check the dates of a range, that are pasted into queries and document id bounds. Missing dates are left out of the range.
+def _checkDates(*dates):
+    if any(date is not None and not isDate(date) for date in dates):
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, "Invalid dates selected")
+
+@router.get('/rooms')
+async def listRooms(limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE), start_after: str | None = None, fields: str | None = None):
+    """Rooms ordered by name, `start_after` is the name of the last room of the previous page."""
+    fields = _fields(fields)
+    query = firestore_db.collection('rooms').order_by('name')
+    if fields:
+        query = query.select(list(set(fields) | {'name'}))
+    if start_after:
+        query = query.start_after({'name': start_after})
+    rooms = [room async for room in query.limit(limit).stream()]
+    return dict(
+        items=[_project(dict(room.to_dict(), id=room.id), fields) for room in rooms],
+        next=rooms[-1].get('name') if len(rooms) == limit else None
+    )
+
+@router.get('/rooms/{room}/bookings')
+async def listRoomBookings(room: str, start: str, end: str, limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE), start_after: str | None = None, fields: str | None = None):
+    """Bookings on a room from the `start` to the `end` date (inclusive), ordered by date and time.
+
+    `start_after` is the id of the last booking of the previous page.
+    """
+    room_id = _room(room).id
+    _checkDates(start, end)
+    fields = _fields(fields)
+    query = roomBookingsQuery(room_id, start, end)
+    if start_after:
+        # booking ids sort by date and time, so the page continues after the cursor's id
+        if not start_after.startswith(f"{room_id}_"):
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, "Unknown start_after cursor")
+        bookings = firestore_db.collection('bookings')
+        query = query.where(filter=FieldFilter(FieldPath.document_id(), '>', bookings.document(start_after)))
+    if fields:
+        query = query.select(fields)
+    bookings = [booking async for booking in query.limit(limit).stream()]
+    return dict(
+        items=[_project(dict(booking.to_dict(), id=booking.id), fields) for booking in bookings],
+        next=bookings[-1].id if len(bookings) == limit else None
+    )
+
+@router.get('/rooms/{room}/stats')
+async def roomStats(room: str, start: str, end: str, period: str = Query('day', regex='^(day|week|month)$')):
+    """Bookings, minutes booked and minutes booked in every hour (00:00 to 23:00) on a room from the `start` to the `end`
+    date (inclusive), per day, week (from Monday) or month, with the busiest hour. Read from the room's daily stats."""
+    room_id = _room(room).id
+    try:
+        start, end = datetime.date.fromisoformat(start), datetime.date.fromisoformat(end)
+    except ValueError:
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, "Invalid dates selected")
+    if end < start or (end - start).days >= MAX_STATS_DAYS:
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, f"Select a range of at most {MAX_STATS_DAYS} days")
+    return dict(items=await getRoomStats(room_id, start, end, period))
+
+@router.post('/rooms/{room}/bookings', status_code=status.HTTP_201_CREATED)
+async def createRoomBooking(room: str, body: BookingIn, user = Depends(getCurrentUser)):
+    """Book a room, with the same validation as the booking form.
+
+    A repeating booking is booked on every date of its recurrence or, if some of them clash, on none
+    and the response lists all the conflicting dates.
+    """
+    booking = {
+        'name': body.name,
+        'date': body.date,
+        'room': room,
+        'from': body.start,
+        'to': body.end,
+        'user': user.id
+    }
+    errors = validateBooking(booking)
+    if errors:
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, errors)
+    try:
+        if body.repeat:
+            bookings = await createRecurringBooking(_room(room).id, booking, body.repeat, body.interval, body.until or body.date)
+            return dict(items=bookings)
+        await createBooking(_room(room).id, booking)
+    except InvalidRecurrence as err:
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, str(err))
+    except RoomNotFound as err:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, str(err))
+    except RecurringConflict as err:
+        raise HTTPException(status.HTTP_409_CONFLICT, dict(message=str(err), conflicts=[dict(date=date, message=message) for date, message in err.conflicts]))
+    except BookingConflict as err:
+        slot = err.schedule.nextFreeSlot(toMinutes(booking['to']) - toMinutes(booking['from']), booking['from'])
+        raise HTTPException(status.HTTP_409_CONFLICT, dict(message=str(err), next_free_slot=slot))
+    except BookingAborted:
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "The room is busy right now, please try again", headers={'Retry-After': '1'})
+    return booking
+
+@router.delete('/rooms/{room}/bookings/{date}/{start}', status_code=status.HTTP_204_NO_CONTENT)
+async def deleteRoomBooking(room: str, date: str, start: str, end: str, user = Depends(getCurrentUser)):
+    """Delete one of the user's bookings, identified by room, date, start and end time."""
+    room = _room(room)
+    try:
+        booking = await cancelBooking(room.id, room.name, date, start, end, user.id)
+    except BookingAborted:
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "The room is busy right now, please try again", headers={'Retry-After': '1'})
+    if booking is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "No such booking")
+
+@router.delete('/rooms/{room}', status_code=status.HTTP_202_ACCEPTED)
+async def deleteRoom(room: str, user = Depends(getCurrentUser)):
+    """Delete one of the user's rooms, it must not have bookings from today on.
+
+    The room is deleted right away and its past bookings by a background job. Returns the job's
+    status, which can be polled at `/room-deletions/{id}` until it is `done` or `failed`.
+    """
+    room = _room(room)
+    if room.user_id != user.id:
+        raise HTTPException(status.HTTP_403_FORBIDDEN, "Rooms can only be deleted by the person who created it.")
+    try:
+        return await startRoomDeletion(room, user)
+    except RoomHasBookings as err:
+        raise HTTPException(status.HTTP_409_CONFLICT, str(err))
+    except RoomNotFound as err:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, str(err))
+    except RoomDeletionAborted:
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "The room is busy right now, please try again", headers={'Retry-After': '1'})
+
+@router.get('/room-deletions/{job_id}')
+async def roomDeletionStatus(job_id: str, user = Depends(getCurrentUser)):
+    """Status of a room deletion job started by the user: running, done or failed, with the number of bookings deleted so far."""
+    job = await getRoomDeletion(job_id, user.id)
+    if job is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "No such job")
+    return job
+
+@router.get('/me/bookings')
+async def listMyBookings(user = Depends(getCurrentUser), start: str | None = None, end: str | None = None, limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE), start_after: str | None = None, fields: str | None = None):
+    """The user's bookings ordered by date, optionally from the `start` to the `end` date (inclusive).
+
+    `start_after` is the id of the last booking of the previous page.
+    """
+    _checkDates(start, end)
+    fields = _fields(fields)
+    index = bookingIndex(user.id)
+    query = index.order_by('date')
+    if start:
+        query = query.where(filter=FieldFilter('date', '>=', start))
+    if end:
+        query = query.where(filter=FieldFilter('date', '<=', end))
+    if fields:
+        query = query.select(list(set(fields) | {'date'}))
+    if start_after:
+        cursor = await index.document(start_after).get()
+        if not cursor.exists:
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, "Unknown start_after cursor")
+        query = query.start_after(cursor)
+    bookings = [booking async for booking in query.limit(limit).stream()]
+    return dict(
+        items=[_project(dict(booking.to_dict(), id=booking.id), fields) for booking in bookings],
+        next=bookings[-1].id if len(bookings) == limit else None
+    )
+
+@router.get('/availability')
+async def searchAvailability(date: str, start: str = DAY_START, end: str = DAY_END, duration: int = Query(60, ge=1, le=MINUTES_PER_DAY)):
+    """Every room with a free slot of `duration` minutes between the `start` and `end` times on `date`, with the earliest such slot."""
+    if not isDate(date):
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, "Invalid date selected")
+    if not isTime(start) or not isTime(end) or start >= end:
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, "Invalid start and end time selected")
+    return dict(items=await findAvailableRooms(room_catalog.rooms(), date, start, end, duration))
+
+@router.post('/bookings/import')
+async def importRoomBookings(request: Request, format: str = Query('csv', regex='^(csv|jsonl)$'), user = Depends(getCurrentUser)):
+    """Book every row of a CSV (with a name,date,room,from,to header) or JSONL file sent as the request body.
+
+    The body is parsed as it streams in. Returns the number of rows created and failed and, for every row,
+    its line number, its status and the reason it failed.
+    """
+    return await importBookings(request.stream(), format, user.id)
+
+# Function to stream an export of bookings as a file download in the requested format, `name` is the calendar's name
+def _export(bookings, format, name, filename):
+    media_type, render = export.FORMATS[format]
+    return StreamingResponse(render(bookings, name), media_type=media_type, headers={'Content-Disposition': f'attachment; filename="{filename}.{format}"'})
+
+@router.get('/export/bookings')
+async def exportBookings(format: str = Query('csv', regex='^(csv|ics)$'), start: str | None = None, end: str | None = None):
+    """Every booking on every room, optionally from the `start` to the `end` date (inclusive), as CSV or iCalendar."""
+    _checkDates(start, end)
+    return _export(export.allBookings(start, end), format, 'Bookings', 'bookings')
+
+@router.get('/export/rooms/{room}/bookings')
+async def exportRoomBookings(room: str, format: str = Query('csv', regex='^(csv|ics)$'), start: str | None = None, end: str | None = None):
+    """The bookings on a room, optionally from the `start` to the `end` date (inclusive), as CSV or iCalendar."""
+    _checkDates(start, end)
+    return _export(export.roomBookings(_room(room).id, start, end), format, room, 'room-bookings')
+
+@router.get('/export/me/bookings')
+async def exportMyBookings(user = Depends(getCurrentUser), format: str = Query('csv', regex='^(csv|ics)$'), start: str | None = None, end: str | None = None):
+    """The user's bookings, optionally from the `start` to the `end` date (inclusive), as CSV or iCalendar."""
+    _checkDates(start, end)
+    return _export(export.userBookings(user.id, start, end), format, 'My bookings', 'my-bookings')
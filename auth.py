@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+from fastapi import Depends, Request
+import google.auth.exceptions
+from google.auth import jwt
+from google.auth.transport import requests
+from database import getOrCreateUser
+from metrics import recordTokenVerification
+
+# Set up request adapter for Firebase authentication
+firebase_request_adapter = requests.Request()
+
+# Endpoint with the public certificates Firebase signs ID tokens with, keyed by key id
+FIREBASE_CERTS_URL = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+
+# Refresh the certificates this many seconds before Google says they go stale, and retry
+# this often when a refresh fails (the old certificates are kept until then)
+CERTS_REFRESH_MARGIN = 60
+CERTS_RETRY_INTERVAL = 30
+
+# Maximum number of verified tokens kept in memory
+TOKEN_CACHE_SIZE = 10000
+
+_certs = {}
+_certs_expiry = 0.0
+_certs_lock = asyncio.Lock()
+_certs_refresh_handle = None
+
+# sha256 of the raw token -> decoded token, least recently used first
+_token_cache = OrderedDict()
+
+# Function to download the signing certificates and how long they can be cached for
+def _fetchCerts():
+    response = firebase_request_adapter(FIREBASE_CERTS_URL, method='GET')
+    if response.status != 200:
+        raise google.auth.exceptions.TransportError(f"Could not fetch certificates at {FIREBASE_CERTS_URL}")
+
+    max_age = 0
+    match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+    if match:
+        max_age = int(match.group(1))
+    return json.loads(response.data.decode('utf-8')), max_age
+
+# Function to schedule the next certificate refresh so it happens in the background, off the request path
+def _scheduleCertsRefresh(delay):
+    global _certs_refresh_handle
+    if _certs_refresh_handle is not None:
+        _certs_refresh_handle.cancel()
+    loop = asyncio.get_running_loop()
+    _certs_refresh_handle = loop.call_later(max(delay, 1), lambda: loop.create_task(_backgroundCertsRefresh()))
+
+async def _backgroundCertsRefresh():
+    try:
+        await refreshCerts()
+    except google.auth.exceptions.TransportError as err:
+        print(str(err))
+        _scheduleCertsRefresh(CERTS_RETRY_INTERVAL)
+
+# Function to (re)load the signing certificates, honouring the Cache-Control max-age of the response
+async def refreshCerts():
+    global _certs, _certs_expiry
+    certs, max_age = await asyncio.to_thread(_fetchCerts)
+    _certs = certs
+    _certs_expiry = time.time() + max_age
+    _scheduleCertsRefresh(max_age - CERTS_REFRESH_MARGIN)
+
+# Function to get the signing certificates, only fetching them when nothing usable is cached
+async def getCerts():
+    if not _certs or time.time() >= _certs_expiry:
+        async with _certs_lock:
+            if not _certs or time.time() >= _certs_expiry:
+                await refreshCerts()
+    return _certs
+
+# Function to validate Firebase ID token and retrieve user information
+async def validateFirebaseToken(id_token):
+    if not id_token:
+        return None
+
+    # tokens that were already verified are served from the cache until they expire
+    key = hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+    user_token = _token_cache.get(key)
+    if user_token is not None:
+        if user_token['exp'] > time.time():
+            _token_cache.move_to_end(key)
+            return user_token
+        del _token_cache[key]
+
+    user_token = None
+    try:
+        certs = await getCerts()
+        # the RSA signature check is CPU bound so it runs outside of the event loop
+        user_token = await asyncio.to_thread(jwt.decode, id_token, certs=certs, audience=None)
+    except ValueError as err:
+        print(str(err))
+        return None
+
+    _token_cache[key] = user_token
+    if len(_token_cache) > TOKEN_CACHE_SIZE:
+        _token_cache.popitem(last=False)
+    return user_token
+
+class LoginRequired(Exception):
+    """Raised by the dependencies below when the request has no valid Firebase login."""
+
+# Dependency to validate the token cookie of the request, the login box is shown when it is missing or invalid
+async def getUserToken(request: Request):
+    started = time.perf_counter()
+    user_token = await validateFirebaseToken(request.cookies.get("token"))
+    recordTokenVerification(time.perf_counter() - started)
+    if not user_token:
+        raise LoginRequired()
+    return user_token
+
+# Dependency to load the logged in user's document, FastAPI resolves it (and the token) once per request
+async def getCurrentUser(user_token: dict = Depends(getUserToken)):
+    return await getOrCreateUser(user_token['user_id'])
@@ -0,0 +1,50 @@
+import numpy as np
+from google.cloud.firestore_v1.base_query import FieldFilter
+from database import firestore_db
+from intervals import toMinutes, toTime
+
+MINUTES_PER_DAY = 24 * 60
+
+# Function to build the occupancy bitmap of a day from its bookings: one row per room, one column per minute, True where the room is booked
+def occupancy(room_ids, bookings):
+    rows = {room_id: row for row, room_id in enumerate(room_ids)}
+    starts, ends, booking_rows = [], [], []
+    for booking in bookings:
+        row = rows.get(booking['room_id'])
+        if row is None:
+            continue
+        booking_rows.append(row)
+        starts.append(toMinutes(booking['from']))
+        ends.append(toMinutes(booking['to']))
+
+    # +1 where a booking starts and -1 where it ends, the running sum is then the number of bookings
+    # covering each minute, all without looping over the minutes in Python
+    changes = np.zeros((len(room_ids), MINUTES_PER_DAY + 1), dtype=np.int16)
+    np.add.at(changes, (booking_rows, starts), 1)
+    np.add.at(changes, (booking_rows, ends), -1)
+    return np.cumsum(changes[:, :MINUTES_PER_DAY], axis=1) > 0
+
+# Function to find the first free slot of `duration` minutes between `start` and `end` in every row of the
+# bitmap, returns the start minute of the slot per row or -1 where there is none
+def firstFreeSlots(booked, start, end, duration):
+    if duration <= 0 or end - start < duration:
+        return np.full(booked.shape[0], -1)
+    free = ~booked[:, start:end]
+    # free minutes in every window of `duration` minutes, from the running count of free minutes
+    counts = np.zeros((free.shape[0], free.shape[1] + 1), dtype=np.int32)
+    np.cumsum(free, axis=1, out=counts[:, 1:])
+    windows = (counts[:, duration:] - counts[:, :-duration]) == duration
+    found = windows.any(axis=1)
+    return np.where(found, windows.argmax(axis=1) + start, -1)
+
+# Function to get the rooms with a free slot of `duration` minutes between the `start` and `end` times on a date.
+# `rooms` are catalog entries; all the bookings on the date are read with one query, only the fields needed for the bitmap.
+async def findAvailableRooms(rooms, date, start, end, duration):
+    query = firestore_db.collection('bookings').where(filter=FieldFilter('date', '==', date)).select(['room_id', 'from', 'to'])
+    bookings = [booking.to_dict() async for booking in query.stream()]
+    booked = occupancy([room.id for room in rooms], bookings)
+    slots = firstFreeSlots(booked, toMinutes(start), toMinutes(end), duration)
+    return [
+        {'room': room.name, 'from': toTime(int(slot)), 'to': toTime(int(slot) + duration)}
+        for room, slot in zip(rooms, slots) if slot >= 0
+    ]
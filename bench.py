@@ -0,0 +1,196 @@
+"""Benchmarks of the booking routes, run in process against the in-memory store.
+
+    python bench.py --rooms 50 --days 30 --bookings-per-day 8 --users 20 --requests 200 --concurrency 10
+
+A synthetic dataset of the given size is written first, then every route gets `--requests` requests
+from `--concurrency` concurrent clients going through the ASGI app, with the login cookie checked by
+a stub instead of Firebase. For each route it reports the throughput, the p50/p95/p99 latency and the
+Firestore operations per request. The results are saved as JSON with the dataset parameters, and
+`--baseline` compares them with an earlier run so regressions show up between releases.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import statistics
+import time
+
+# the store has to be chosen before the app (and with it the client) is imported
+os.environ['BOOKING_STORAGE'] = 'memory'
+
+import httpx
+import auth
+import main
+from catalog import room_catalog
+from database import firestore_db, bookingIndex, bookingKey, bookingRef, bookingData
+from intervals import toTime
+from roomstats import dayStats, statsRef
+
+# Firestore rejects batches with more writes than this
+BATCH_SIZE = 500
+
+# Start of the seeded days, far enough ahead that bookings on them are never in the past
+FIRST_DAY = datetime.date.today() + datetime.timedelta(days=30)
+
+# Function standing in for the Firebase token check, the token is the user id
+async def stubToken(id_token):
+    return {'user_id': id_token, 'email': f"{id_token}@bench.invalid"} if id_token else None
+
+# Function to write the synthetic dataset: users, rooms, one-hour bookings from 07:00 on every day, the bookings index and the rooms' daily stats.
+# Returns the bookings of every user, for the routes that act on existing bookings.
+async def seed(rooms, days, bookings_per_day, users):
+    user_ids = [f"user{index}" for index in range(users)]
+    owned = {user_id: [] for user_id in user_ids}
+    batch, writes = firestore_db.batch(), 0
+
+    async def write(method, reference, data):
+        nonlocal batch, writes
+        getattr(batch, method)(reference, data)
+        writes += 1
+        if writes == BATCH_SIZE:
+            await batch.commit()
+            batch, writes = firestore_db.batch(), 0
+
+    room_refs = {user_id: [] for user_id in user_ids}
+    for index in range(rooms):
+        user_id = user_ids[index % users]
+        room_ref = firestore_db.collection('rooms').document()
+        room_name = f"Room {index}"
+        await write('set', room_ref, {'name': room_name, 'owner': f"{user_id}@bench.invalid", 'user_id': user_id, 'date_created': str(datetime.date.today())})
+        room_refs[user_id].append(room_ref)
+        for day in range(days):
+            date = (FIRST_DAY + datetime.timedelta(days=day)).isoformat()
+            day_bookings = []
+            for slot in range(bookings_per_day):
+                booking_user = random.choice(user_ids)
+                booking = {'name': f"Meeting {slot}", 'date': date, 'room': room_name, 'from': toTime(7 * 60 + slot * 60), 'to': toTime(8 * 60 + slot * 60), 'user': booking_user}
+                owned[booking_user].append(booking)
+                await write('set', bookingRef(room_ref.id, booking), bookingData(room_ref.id, booking))
+                await write('set', bookingIndex(booking_user).document(bookingKey(room_ref.id, booking)), bookingData(room_ref.id, booking))
+                day_bookings.append(booking)
+            if day_bookings:
+                await write('set', statsRef(room_ref.id, date), dict(dayStats(day_bookings)[date], room_id=room_ref.id, date=date))
+    for user_id in user_ids:
+        await write('set', firestore_db.collection('users').document(user_id), {'username': user_id, 'rooms_list': room_refs[user_id]})
+    await batch.commit()
+    return owned
+
+# Functions building the request of each route, `number` counts the requests sent to the route so far
+def workloads(rooms, days, bookings_per_day, owned):
+    users = list(owned)
+    first_free = 7 * 60 + bookings_per_day * 60
+
+    def root(number):
+        return random.choice(users), 'GET', '/', None
+
+    def bookRoom(number):
+        # a free slot after the seeded bookings of the day, or a clash once the day is full
+        date = (FIRST_DAY + datetime.timedelta(days=random.randrange(days))).isoformat()
+        start = random.randrange(first_free, 22 * 60, 30) if first_free < 22 * 60 else 7 * 60
+        form = {'eventName': f"Bench {number}", 'roomName': f"Room {random.randrange(rooms)}", 'bookingDate': date, 'bookingStartTime': toTime(start), 'bookingEndTime': toTime(start + 30)}
+        return random.choice(users), 'POST', '/book-room', form
+
+    def viewBookings(number):
+        return random.choice(users), 'GET', '/view-bookings', None
+
+    def viewRoom(number):
+        return random.choice(users), 'GET', f"/view-room/Room {random.randrange(rooms)}", None
+
+    def editBooking(number):
+        # opening the edit form takes the booking off its day, so every request edits a different booking
+        user_id = random.choice([user_id for user_id in users if owned[user_id]] or users)
+        booking = owned[user_id].pop() if owned[user_id] else {'room': 'Room 0', 'date': FIRST_DAY.isoformat(), 'from': '07:00', 'to': '08:00'}
+        params = f"booking_room={booking['room']}&date={booking['date']}&start={booking['from']}&end={booking['to']}"
+        return user_id, 'GET', f"/edit-booking?{params}", None
+
+    return {
+        '/': root,
+        '/book-room': bookRoom,
+        '/view-bookings': viewBookings,
+        '/view-room/{room}': viewRoom,
+        '/edit-booking': editBooking,
+    }
+
+def percentile(latencies, percent):
+    return statistics.quantiles(latencies, n=100, method='inclusive')[percent - 1] if len(latencies) > 1 else latencies[0]
+
+# Function to send `requests` requests built by `workload` from `concurrency` clients, returns the route's results
+async def run(client, workload, requests, concurrency):
+    latencies, statuses = [], {}
+    numbers = iter(range(requests))
+    operations = dict(firestore_db.operations)
+
+    async def worker():
+        for number in numbers:
+            user_id, method, url, form = workload(number)
+            started = time.perf_counter()
+            response = await client.request(method, url, data=form, cookies={'token': user_id})
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': requests,
+        'throughput': requests / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'statuses': statuses,
+        'operations_per_request': {kind: (count - operations.get(kind, 0)) / requests for kind, count in firestore_db.operations.items()},
+    }
+
+def report(results, baseline=None):
+    print(f"{'route':<20}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'docs/req':>11}{'queries/req':>13}{'commits/req':>13}")
+    for route, result in results['routes'].items():
+        operations = result['operations_per_request']
+        print(f"{route:<20}{result['throughput']:>10.1f}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+              f"{operations.get('documents_read', 0):>11.1f}{operations.get('queries', 0):>13.1f}{operations.get('commits', 0):>13.1f}")
+        if baseline and route in baseline['routes']:
+            previous = baseline['routes'][route]
+            print(f"{'  vs baseline':<20}{result['throughput'] / previous['throughput'] - 1:>+10.0%}{result['p50_ms'] / previous['p50_ms'] - 1:>+10.0%}"
+                  f"{result['p95_ms'] / previous['p95_ms'] - 1:>+10.0%}{result['p99_ms'] / previous['p99_ms'] - 1:>+10.0%}")
+
+async def benchmark(args):
+    random.seed(args.seed)
+    auth.validateFirebaseToken = stubToken
+    room_catalog.start()
+    owned = await seed(args.rooms, args.days, args.bookings_per_day, args.users)
+
+    results = {'dataset': {key: getattr(args, key) for key in ('rooms', 'days', 'bookings_per_day', 'users', 'requests', 'concurrency', 'latency')}, 'routes': {}}
+    # errors are counted as 500 responses instead of stopping the run
+    transport = httpx.ASGITransport(app=main.app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        for route, workload in workloads(args.rooms, args.days, args.bookings_per_day, owned).items():
+            results['routes'][route] = await run(client, workload, args.requests, args.concurrency)
+    room_catalog.stop()
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rooms', type=int, default=50)
+    parser.add_argument('--days', type=int, default=30, help="days with bookings per room")
+    parser.add_argument('--bookings-per-day', type=int, default=8, help="one-hour bookings per day, at most 16")
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=200, help="requests per route")
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=1, help="milliseconds added to every Firestore round trip")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench-results.json')
+    parser.add_argument('--baseline', help="results of an earlier run to compare with")
+    args = parser.parse_args()
+    args.bookings_per_day = min(args.bookings_per_day, 16)
+
+    firestore_db.latency = args.latency / 1000
+    results = asyncio.run(benchmark(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    report(results, baseline)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"Saved to {args.output}")
@@ -0,0 +1,191 @@
+import asyncio
+import datetime
+from collections import Counter
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+from storage import transactional, runTransaction, TransactionAborted
+from database import firestore_db, dayPrefix, bookingRef, bookingData, getDaySchedule, indexBooking, unindexBooking
+from intervals import toMinutes, isTime, isDate, clashMessage
+from versions import roomChanged
+from roomstats import countBookings
+
+# Most occurrences a recurring booking can expand to, each one writes its booking, its index entry and the stats
+# of its day, and a transaction can't hold more than 500 writes
+MAX_OCCURRENCES = 160
+
+# Days between two occurrences of a recurring booking with an interval of 1
+FREQUENCIES = {'daily': 1, 'weekly': 7}
+
+class RoomNotFound(Exception):
+    """Raised when the room being booked no longer exists."""
+
+class BookingConflict(Exception):
+    """Raised when the new booking overlaps an existing one, carries the day's schedule so callers can suggest a free slot."""
+
+    def __init__(self, message, schedule):
+        super().__init__(message)
+        self.schedule = schedule
+
+class RecurringConflict(Exception):
+    """Raised when occurrences of a recurring booking overlap existing bookings, carries the conflicting dates and messages."""
+
+    def __init__(self, conflicts):
+        super().__init__(f"The room is already booked on {', '.join(date for date, message in conflicts)}")
+        self.conflicts = conflicts
+
+class InvalidRecurrence(Exception):
+    """Raised when the rule of a recurring booking is invalid."""
+
+class BookingAborted(Exception):
+    """Raised when a booking could not be committed in MAX_ATTEMPTS because of contention on the room."""
+
+# Counters of the booking transactions: commits, retries, aborts and conflicts.
+# Retries and aborts are also counted per room name so hot rooms show up under load.
+booking_metrics = Counter()
+room_retries = Counter()
+room_aborts = Counter()
+
+# Function to check the date and times of a new booking, returns the error message to show or None if they are valid
+def validateBooking(booking):
+    # the times are checked before anything is parsed from them
+    if not isTime(booking['from']) or not isTime(booking['to']) or booking['from'] >= booking['to']:
+        return "Invalid start and end time selected"
+    if not isDate(booking['date']):
+        return "Invalid date selected"
+    date = datetime.date.fromisoformat(booking['date'])
+    if date == datetime.date.today():
+        # If booking date is today and booking time is past
+        if datetime.time.fromisoformat(booking['from']) < datetime.time.fromisoformat(datetime.datetime.now().time().isoformat(timespec='minutes')):
+            return "Select a valid time"
+    return None
+
+# Function to find the booking on a room that overlaps a new one, inside the transaction. Bookings never overlap,
+# so the only one that can is the last booking of the day starting before the new one ends (see DaySchedule),
+# and that is all the query reads. The transaction then only conflicts with writers booking the same stretch
+# of the day, not with every booking made on the room that day.
+async def _findClash(transaction, room_id, booking):
+    bookings = firestore_db.collection('bookings')
+    query = bookings.where(filter=FieldFilter(FieldPath.document_id(), '>=', bookings.document(dayPrefix(room_id, booking['date']))))
+    query = query.where(filter=FieldFilter(FieldPath.document_id(), '<', bookings.document(dayPrefix(room_id, booking['date']) + booking['to'].replace(':', ''))))
+    query = query.order_by(FieldPath.document_id(), direction='DESCENDING').limit(1)
+    async for previous in query.stream(transaction=transaction):
+        if toMinutes(previous.get('to')) > toMinutes(booking['from']):
+            return previous.to_dict()
+    return None
+
+# Function run (and re-run on contention) inside the transaction. The room, the conflict check and all the
+# writes happen in one transaction, so two overlapping bookings can't both succeed.
+@transactional
+async def _createBooking(transaction, room_ref, booking, attempts):
+    attempts[0] += 1
+    # the room and the booking that could clash are read concurrently
+    room, clash = await asyncio.gather(room_ref.get(transaction=transaction), _findClash(transaction, room_ref.id, booking))
+    if not room.exists:
+        raise RoomNotFound("The selected room is no longer available")
+    if clash is not None:
+        # the whole day is only read to suggest a free slot
+        raise BookingConflict(clashMessage(clash), await getDaySchedule(room_ref.id, booking['date'], transaction))
+
+    transaction.create(bookingRef(room_ref.id, booking), bookingData(room_ref.id, booking))
+    indexBooking(transaction, room_ref.id, booking)
+    countBookings(transaction, room_ref.id, [booking])
+    return booking
+
+# Function to expand a recurring booking into one booking per occurrence, every `interval` days or weeks
+# from the booking's date up to and including `until`. Raises InvalidRecurrence if the rule is invalid.
+def expandOccurrences(booking, frequency, interval, until):
+    if frequency not in FREQUENCIES or interval < 1:
+        raise InvalidRecurrence("Invalid recurrence selected")
+    date = datetime.date.fromisoformat(booking['date'])
+    try:
+        until = datetime.date.fromisoformat(until)
+    except (TypeError, ValueError):
+        raise InvalidRecurrence("Invalid end date of the recurrence selected")
+    if until < date:
+        raise InvalidRecurrence("The recurrence has to end after the first booking")
+    # an interval longer than the recurrence gives one occurrence, capping it keeps huge intervals from overflowing
+    step = datetime.timedelta(days=FREQUENCIES[frequency] * min(interval, (until - date).days + 1))
+    if (until - date) // step + 1 > MAX_OCCURRENCES:
+        raise InvalidRecurrence(f"A recurring booking can have at most {MAX_OCCURRENCES} occurrences")
+    occurrences = []
+    while date <= until:
+        occurrences.append(dict(booking, date=date.isoformat()))
+        date += step
+    return occurrences
+
+# Function run (and re-run on contention) inside the transaction for all the occurrences of a recurring booking.
+# Every occurrence is checked, with its queries running concurrently, before anything is written, so either all
+# occurrences are booked or none is and the conflicting dates are reported together.
+@transactional
+async def _createBookings(transaction, room_ref, bookings, attempts):
+    attempts[0] += 1
+    room, *clashes = await asyncio.gather(room_ref.get(transaction=transaction), *[_findClash(transaction, room_ref.id, booking) for booking in bookings])
+    if not room.exists:
+        raise RoomNotFound("The selected room is no longer available")
+
+    conflicts = [(booking['date'], clashMessage(clash)) for booking, clash in zip(bookings, clashes) if clash is not None]
+    if conflicts:
+        raise RecurringConflict(conflicts)
+
+    for booking in bookings:
+        transaction.create(bookingRef(room_ref.id, booking), bookingData(room_ref.id, booking))
+        indexBooking(transaction, room_ref.id, booking)
+    countBookings(transaction, room_ref.id, bookings)
+    return bookings
+
+# Function run (and re-run on contention) inside the transaction to delete a booking,
+# bookings can only be removed by the user who made them
+@transactional
+async def _cancelBooking(transaction, room_ref, date, start, end, user_id, attempts):
+    attempts[0] += 1
+    snapshot = await bookingRef(room_ref.id, {'date': date, 'from': start}).get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+
+    booking = snapshot.to_dict()
+    booking.pop('room_id', None)
+    if booking['to'] == end and booking['user'] == user_id:
+        transaction.delete(snapshot.reference)
+        unindexBooking(transaction, room_ref.id, booking)
+        countBookings(transaction, room_ref.id, [booking], -1)
+        return booking
+    return None
+
+# Function to run one of the transactions above and keep the counters up to date. The transactions return what they
+# wrote, None when they wrote nothing, which doesn't count as a commit and leaves the room's version alone.
+async def _runTransaction(transactional, room_id, room_name, *args):
+    room_ref = firestore_db.collection('rooms').document(room_id)
+    attempts = [0]
+    try:
+        result = await runTransaction(firestore_db, transactional, room_ref, *args, attempts)
+    except (BookingConflict, RecurringConflict):
+        booking_metrics['conflicts'] += 1
+        raise
+    except TransactionAborted as err:
+        booking_metrics['aborts'] += 1
+        room_aborts[room_name] += 1
+        raise BookingAborted(str(err))
+    else:
+        if result is not None:
+            booking_metrics['commits'] += 1
+            roomChanged(room_id)
+        return result
+    finally:
+        if attempts[0] > 1:
+            booking_metrics['retries'] += attempts[0] - 1
+            room_retries[room_name] += attempts[0] - 1
+
+# Function to add a booking to a room, raises RoomNotFound, BookingConflict or BookingAborted if it can't
+async def createBooking(room_id, booking):
+    await _runTransaction(_createBooking, room_id, booking['room'], booking)
+
+# Function to add every occurrence of a recurring booking to a room, raises RoomNotFound, RecurringConflict
+# (with all the conflicting dates) or BookingAborted if it can't. Returns the bookings that were made.
+async def createRecurringBooking(room_id, booking, frequency, interval, until):
+    bookings = expandOccurrences(booking, frequency, interval, until)
+    await _runTransaction(_createBookings, room_id, booking['room'], bookings)
+    return bookings
+
+# Function to remove a user's booking from start to end on a room and date, returns it or None if there was no such booking
+async def cancelBooking(room_id, room_name, date, start, end, user_id):
+    return await _runTransaction(_cancelBooking, room_id, room_name, date, start, end, user_id)
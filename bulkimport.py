@@ -0,0 +1,157 @@
+import asyncio
+import codecs
+import csv
+import datetime
+import json
+from storage import transactional, runTransaction, TransactionAborted
+from database import firestore_db, bookingRef, bookingData, getDaySchedule, indexBooking
+from catalog import room_catalog
+from booking import validateBooking
+from versions import roomChanged
+from roomstats import countBookings
+
+# Firestore rejects transactions with more writes than this, every imported booking writes its document, its index entry
+# and, at most, the stats of its day
+BATCH_SIZE = 500
+
+# Columns of an import file, the same fields as the booking form
+FIELDS = ('name', 'date', 'room', 'from', 'to')
+
+# Function to split a stream of byte chunks into lines of text without holding the whole body in memory
+async def _lines(chunks):
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    pending = ''
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split('\n')
+        for line in lines:
+            yield line.rstrip('\r')
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending.rstrip('\r')
+
+# Function to parse an uploaded CSV (with a header row) or JSONL file, yields (line number, row or error message).
+# CSV rows have to fit on one line.
+async def parseRows(chunks, format):
+    header = None
+    line_number = 0
+    async for line in _lines(chunks):
+        line_number += 1
+        if not line.strip():
+            continue
+        if format == 'jsonl':
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield line_number, "Invalid JSON"
+                continue
+            if not isinstance(row, dict):
+                yield line_number, "Invalid JSON"
+                continue
+        else:
+            values = next(csv.reader([line]))
+            if header is None:
+                header = [value.strip() for value in values]
+                continue
+            row = dict(zip(header, values))
+        missing = [field for field in FIELDS if not row.get(field)]
+        if missing:
+            yield line_number, f"Missing {', '.join(missing)}"
+            continue
+        yield line_number, {field: str(row[field]).strip() for field in FIELDS}
+
+# Function to check the fields of an imported row, returns the error message or None if it can be booked
+def _checkRow(booking):
+    try:
+        datetime.date.fromisoformat(booking['date'])
+        datetime.time.fromisoformat(booking['from'])
+        datetime.time.fromisoformat(booking['to'])
+    except ValueError:
+        return "Invalid date or time"
+    if booking['room'] not in room_catalog:
+        return "The selected room is no longer available"
+    return validateBooking(booking)
+
+async def importBookings(chunks, format, user_id):
+    """Book every row of an import file for the user, returns a report with one entry per row.
+
+    Rows are grouped by room and day while the file is read, and then booked in batches of up to
+    BATCH_SIZE writes, each in one transaction. A transaction reads the rooms and the bookings of the
+    days its rows are on, with the reads running concurrently, and checks the rows against them with
+    the same overlap rules as the booking form, so rows clash with existing bookings as well as with
+    earlier rows of the file. Bookings made concurrently make the transaction run again, so they are
+    never overwritten.
+    """
+    report = []
+    days = {}
+    async for line, row in parseRows(chunks, format):
+        if isinstance(row, str):
+            report.append({'line': line, 'status': 'failed', 'error': row})
+            continue
+        booking = dict(row, user=user_id)
+        errors = _checkRow(booking)
+        if errors:
+            report.append({'line': line, 'status': 'failed', 'error': errors})
+            continue
+        entry = {'line': line, 'status': 'created', 'booking': booking}
+        report.append(entry)
+        days.setdefault((room_catalog.get(booking['room']).id, booking['date']), []).append(entry)
+
+    # a day can be split between batches, the later batch reads the bookings the earlier one made
+    batch = []
+    for (room_id, date), entries in days.items():
+        for entry in entries:
+            batch.append((room_id, entry))
+            if len(batch) == BATCH_SIZE // 3:
+                await _importBatch(batch)
+                batch = []
+    if batch:
+        await _importBatch(batch)
+    for room_id, date in days:
+        roomChanged(room_id)
+
+    return dict(
+        created=sum(entry['status'] == 'created' for entry in report),
+        failed=sum(entry['status'] == 'failed' for entry in report),
+        rows=report
+    )
+
+# Function run (and re-run on contention) inside the transaction of a batch of rows, sets the status of every row
+@transactional
+async def _bookBatch(transaction, batch):
+    day_keys = list(dict.fromkeys((room_id, entry['booking']['date']) for room_id, entry in batch))
+    room_ids = list(dict.fromkeys(room_id for room_id, date in day_keys))
+    # the rooms are read too, so a room deleted during the import makes the transaction run again and its rows fail
+    results = await asyncio.gather(
+        *[getDaySchedule(room_id, date, transaction) for room_id, date in day_keys],
+        *[firestore_db.collection('rooms').document(room_id).get(transaction=transaction) for room_id in room_ids]
+    )
+    schedules = dict(zip(day_keys, results))
+    rooms = dict(zip(room_ids, results[len(day_keys):]))
+    created = {}
+    for room_id, entry in batch:
+        booking = entry['booking']
+        if not rooms[room_id].exists:
+            entry.update(status='failed', error="The selected room is no longer available")
+            continue
+        try:
+            schedules[(room_id, booking['date'])].insert(booking)
+        except ValueError as err:
+            entry.update(status='failed', error=str(err))
+            continue
+        # a failed row of an earlier attempt may fit now
+        entry['status'] = 'created'
+        entry.pop('error', None)
+        transaction.create(bookingRef(room_id, booking), bookingData(room_id, booking))
+        indexBooking(transaction, room_id, booking)
+        created.setdefault(room_id, []).append(booking)
+    for room_id, bookings in created.items():
+        countBookings(transaction, room_id, bookings)
+
+# Function to book a batch of imported rows, marks them all as failed if the transaction kept colliding with other writers
+async def _importBatch(batch):
+    try:
+        await runTransaction(firestore_db, _bookBatch, batch)
+    except TransactionAborted:
+        for room_id, entry in batch:
+            entry.update(status='failed', error="The room was booked by someone else during the import, please try again")
@@ -0,0 +1,141 @@
+import threading
+from dataclasses import dataclass
+from storage import listenerClient
+
+@dataclass(frozen=True)
+class Room:
+    """The fields of a room document that pages need to list and look up rooms."""
+    id: str
+    name: str
+    owner: str
+    user_id: str
+    date_created: str
+    # secret part of the room's calendar feed URL, see feeds.py
+    calendar_key: str | None = None
+
+class RoomCatalog:
+    """Process wide index of the rooms collection, by name and by document id.
+
+    It is filled by the first snapshot of a listener on the rooms collection and then updated
+    incrementally from the changes Firestore pushes, so handlers never have to stream the
+    collection. The version counter goes up on every change and can be used to tell whether
+    anything derived from the room list is stale, and subscribers are called with the room names
+    that were added and removed by each change (see live.py).
+    """
+
+    def __init__(self):
+        self._by_name = {}
+        self._by_id = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._watch = None
+        self._subscribers = []
+        self.version = 0
+
+    # Function to start listening to the rooms collection, blocks until the initial snapshot arrived
+    def start(self, timeout=30):
+        # the async client does not support listeners, so a sync client is used for this one
+        self._watch = listenerClient().collection('rooms').on_snapshot(self._onSnapshot)
+        self._ready.wait(timeout)
+
+    def stop(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+    # Called from the listener's thread with the documents that changed since the last snapshot
+    def _onSnapshot(self, documents, changes, read_time):
+        with self._lock:
+            names = self._names()
+            for change in changes:
+                document = change.document
+                if change.type.name == 'REMOVED':
+                    self._remove(document.id)
+                else:
+                    self._put(Room(
+                        id=document.id,
+                        name=document.get('name'),
+                        owner=document.get('owner'),
+                        user_id=document.get('user_id'),
+                        date_created=document.get('date_created'),
+                        calendar_key=document.to_dict().get('calendar_key'),
+                    ))
+            self.version += 1
+            self._changed(names)
+        self._ready.set()
+
+    def _put(self, room):
+        old = self._by_id.get(room.id)
+        if old is not None and self._by_name.get(old.name) is old:
+            del self._by_name[old.name]
+        self._by_id[room.id] = room
+        self._by_name[room.name] = room
+
+    def _remove(self, room_id):
+        old = self._by_id.pop(room_id, None)
+        if old is not None and self._by_name.get(old.name) is old:
+            del self._by_name[old.name]
+
+    # Functions to apply a write made by this process right away instead of waiting for the listener to echo it
+    def add(self, room):
+        with self._lock:
+            names = self._names()
+            self._put(room)
+            self.version += 1
+            self._changed(names)
+
+    def remove(self, room_id):
+        with self._lock:
+            names = self._names()
+            self._remove(room_id)
+            self.version += 1
+            self._changed(names)
+
+    # Function to call `callback(added, removed)` with the sorted room names every change added and removed.
+    # It is called with the catalog locked, from the listener's thread or the thread that made the change.
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers.remove(callback)
+
+    # Names before a change, only taken when someone is subscribed to the changes
+    def _names(self):
+        return set(self._by_name) if self._subscribers else None
+
+    def _changed(self, names):
+        if names is None:
+            return
+        added = sorted(set(self._by_name) - names)
+        removed = sorted(names - set(self._by_name))
+        if added or removed:
+            for callback in self._subscribers:
+                callback(added, removed)
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def getById(self, room_id):
+        return self._by_id.get(room_id)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    # Function to get the names of all the rooms, sorted
+    def names(self):
+        with self._lock:
+            return sorted(self._by_name)
+
+    # Function to get all the rooms, sorted by name
+    def rooms(self):
+        with self._lock:
+            return [self._by_name[name] for name in sorted(self._by_name)]
+
+    # Function to get the names of the rooms with the given document ids, skipping rooms that no longer exist
+    def namesOf(self, room_ids):
+        rooms = [self._by_id.get(room_id) for room_id in room_ids]
+        return [room.name for room in rooms if room is not None]
+
+room_catalog = RoomCatalog()
@@ -0,0 +1,82 @@
+from google.api_core.exceptions import Conflict
+from google.cloud.firestore_v1.base_document import DocumentSnapshot
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+from intervals import DaySchedule
+from storage import asyncClient
+
+# Initialize the async Firestore client for database operations (or its in-memory stand-in, see storage.py).
+# Every call made through it has to be awaited, so a slow round trip only suspends the
+# request that issued it instead of blocking the whole worker.
+firestore_db = asyncClient()
+
+# Function to retrieve user data from Firestore or create a default user if not found.
+# The user document is read once, creating it is atomic so two concurrent first requests can't both write it.
+async def getOrCreateUser(user_id):
+    user = firestore_db.collection('users').document(user_id)
+    snapshot = await user.get()
+    if snapshot.exists:
+        return snapshot
+
+    user_data = {
+        "username": '',
+        "rooms_list": []
+    }
+    try:
+        result = await user.create(user_data)
+    except Conflict:
+        # another request created the user in the meantime
+        return await user.get()
+    return DocumentSnapshot(user, user_data, exists=True, read_time=result.update_time, create_time=result.update_time, update_time=result.update_time)
+
+# Bookings are documents of the bookings collection, one per booking, with ids "<room id>_<date>_<start time>"
+# (the same ids as their entries in the users' bookings index). A room can't have two bookings starting at the
+# same time on the same day, and room ids don't contain underscores, so the bookings of a room, or of a room
+# on one date, are exactly a range of document ids and come back ordered by date and start time.
+def dayPrefix(room_id, date):
+    return f"{room_id}_{date}_"
+
+def bookingKey(room_id, booking):
+    return dayPrefix(room_id, booking['date']) + booking['from'].replace(':', '')
+
+def bookingRef(room_id, booking):
+    return firestore_db.collection('bookings').document(bookingKey(room_id, booking))
+
+# Function to get the data of a booking document, the booking with the id of its room
+def bookingData(room_id, booking):
+    return dict(booking, room_id=room_id)
+
+# Function to get the query for the bookings of a room, optionally only from the `start` to the `end` date (inclusive).
+# The upper bounds use "`", the character after "_", to take in every id with the prefix before it.
+# Listeners pass the client of storage.listenerClient, the async client can't listen.
+def roomBookingsQuery(room_id, start=None, end=None, client=None):
+    bookings = (client or firestore_db).collection('bookings')
+    query = bookings.where(filter=FieldFilter(FieldPath.document_id(), '>=', bookings.document(dayPrefix(room_id, start) if start else f"{room_id}_")))
+    upper = f"{room_id}_{end}`" if end else f"{room_id}`"
+    return query.where(filter=FieldFilter(FieldPath.document_id(), '<', bookings.document(upper)))
+
+# Function to get the schedule of a room on a date, read with one range query (in the transaction if one is given)
+async def getDaySchedule(room_id, date, transaction=None):
+    return DaySchedule([booking.to_dict() async for booking in roomBookingsQuery(room_id, date, date).stream(transaction=transaction)])
+
+# Per-user index of bookings, users/{user id}/bookings. Each booking is mirrored there when it is written,
+# so a user's bookings can be listed with one query on their own small collection.
+def bookingIndex(user_id):
+    return firestore_db.collection('users').document(user_id).collection('bookings')
+
+# Functions to add the index updates for a booking to a write batch, so they commit together with the booking
+def indexBooking(batch, room_id, booking):
+    batch.set(bookingIndex(booking['user']).document(bookingKey(room_id, booking)), bookingData(room_id, booking))
+
+def unindexBooking(batch, room_id, booking):
+    batch.delete(bookingIndex(booking['user']).document(bookingKey(room_id, booking)))
+
+# Function to get a user's bookings, optionally only the ones on a room and/or a date, ordered by date and time
+async def getUserBookings(user_id, room=None, date=None):
+    query = bookingIndex(user_id)
+    if room:
+        query = query.where(filter=FieldFilter('room', '==', room))
+    if date:
+        query = query.where(filter=FieldFilter('date', '==', date))
+    bookings = [booking.to_dict() async for booking in query.stream()]
+    return sorted(bookings, key=lambda booking: (booking['date'], booking['from']))
@@ -0,0 +1,128 @@
+import csv
+import datetime
+import io
+from google.cloud.firestore_v1.base_query import FieldFilter
+from database import firestore_db, bookingIndex, bookingKey, roomBookingsQuery
+
+# Number of documents read per query page, only one page of bookings is held in memory at a time
+PAGE_SIZE = 200
+
+# Rendered output is sent in chunks of about this many characters instead of one chunk per booking
+CHUNK_SIZE = 64 * 1024
+
+# Columns of the CSV export, the same fields as the booking form
+CSV_FIELDS = ('name', 'date', 'room', 'from', 'to')
+
+# Function to stream the results of a query page by page, each page continues after the last document of the previous one
+async def _paged(query):
+    cursor = None
+    while True:
+        page = query.limit(PAGE_SIZE)
+        if cursor is not None:
+            page = page.start_after(cursor)
+        documents = [document async for document in page.stream()]
+        for document in documents:
+            yield document
+        if len(documents) < PAGE_SIZE:
+            return
+        cursor = documents[-1]
+
+# Functions to stream (room id, booking) pairs, ordered by date and then by document id, which is the time for one room.
+# All bookings and the bookings of a room come from the booking documents, the bookings of a user from their bookings index.
+async def _bookings(query):
+    async for booking in _paged(query):
+        yield booking.get('room_id'), booking.to_dict()
+
+def allBookings(start=None, end=None):
+    query = firestore_db.collection('bookings').order_by('date')
+    if start:
+        query = query.where(filter=FieldFilter('date', '>=', start))
+    if end:
+        query = query.where(filter=FieldFilter('date', '<=', end))
+    return _bookings(query)
+
+def roomBookings(room_id, start=None, end=None):
+    # the ids of a room's bookings sort by date and time, so the date range is a range of document ids
+    return _bookings(roomBookingsQuery(room_id, start, end))
+
+def userBookings(user_id, start=None, end=None):
+    query = bookingIndex(user_id).order_by('date')
+    if start:
+        query = query.where(filter=FieldFilter('date', '>=', start))
+    if end:
+        query = query.where(filter=FieldFilter('date', '<=', end))
+    return _bookings(query)
+
+# Function to render streamed bookings as CSV
+async def toCsv(bookings):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_FIELDS)
+    async for room_id, booking in bookings:
+        writer.writerow([booking[field] for field in CSV_FIELDS])
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+# Function to escape a text value of an iCalendar property
+def _icsText(value):
+    return str(value).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+# Function to fold an iCalendar content line, lines can be at most 75 octets long
+def _icsLine(line):
+    encoded = line.encode()
+    parts = []
+    while len(encoded) > 75:
+        cut = 75 if not parts else 74
+        # don't split a multi-byte character
+        while encoded[cut] & 0xC0 == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut].decode())
+        encoded = encoded[cut:]
+    parts.append(encoded.decode())
+    return '\r\n '.join(parts) + '\r\n'
+
+def _icsTime(date, time):
+    return date.replace('-', '') + 'T' + time.replace(':', '') + '00'
+
+# Function to render one booking as an iCalendar event. The times are local (floating) times, like the booking form.
+def icsEvent(room_id, booking, stamp):
+    lines = [
+        'BEGIN:VEVENT',
+        f"UID:{bookingKey(room_id, booking)}@booking",
+        f"DTSTAMP:{stamp}",
+        f"DTSTART:{_icsTime(booking['date'], booking['from'])}",
+        f"DTEND:{_icsTime(booking['date'], booking['to'])}",
+        f"SUMMARY:{_icsText(booking['name'])}",
+        f"LOCATION:{_icsText(booking['room'])}",
+        'END:VEVENT',
+    ]
+    return ''.join(_icsLine(line) for line in lines)
+
+def icsHeader(name):
+    return ''.join(_icsLine(line) for line in ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Room Booking Service//EN', f"X-WR-CALNAME:{_icsText(name)}"])
+
+ICS_FOOTER = 'END:VCALENDAR\r\n'
+
+# Function to render streamed bookings as an iCalendar file
+async def toIcs(bookings, name):
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    chunk = [icsHeader(name)]
+    size = 0
+    async for room_id, booking in bookings:
+        event = icsEvent(room_id, booking, stamp)
+        chunk.append(event)
+        size += len(event)
+        if size >= CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk, size = [], 0
+    chunk.append(ICS_FOOTER)
+    yield ''.join(chunk)
+
+# Content type and renderer of each export format
+FORMATS = {
+    'csv': ('text/csv', lambda bookings, name: toCsv(bookings)),
+    'ics': ('text/calendar', toIcs),
+}
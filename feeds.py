@@ -0,0 +1,81 @@
+import datetime
+import hashlib
+import secrets
+import time
+from email.utils import format_datetime, parsedate_to_datetime
+from database import roomBookingsQuery
+from export import icsHeader, icsEvent, ICS_FOOTER
+from versions import roomVersion
+
+# Seconds a rendered feed is served before it is rendered again. Bookings made through this process make the
+# feed of their room stale right away (see versions.py), this only bounds how long changes made by other
+# instances take to show up.
+FEED_MAX_AGE = 300
+
+class RoomFeed:
+    """A rendered calendar feed of a room, with the validators sent to pollers."""
+
+    def __init__(self, body, last_modified, date, version):
+        self.body = body
+        self.etag = '"' + hashlib.sha256(body.encode()).hexdigest() + '"'
+        self.last_modified = last_modified
+        self.date = date
+        self.version = version
+        self.expires = time.monotonic() + FEED_MAX_AGE
+
+    @property
+    def headers(self):
+        return {
+            'ETag': self.etag,
+            'Last-Modified': format_datetime(self.last_modified, usegmt=True),
+            'Cache-Control': f"max-age={FEED_MAX_AGE}",
+        }
+
+# Function to make the key of a new room's calendar feed. Calendar clients can't log in, so the feed URL carries
+# this key instead and only people who were shown the URL can read the room's bookings.
+def newCalendarKey():
+    return secrets.token_urlsafe(24)
+
+# Function to check the key of a feed request against the room's, in constant time
+def calendarKeyMatches(room, key):
+    return room.calendar_key is not None and key is not None and secrets.compare_digest(room.calendar_key, key)
+
+# Rendered feeds by room id
+_feeds = {}
+
+# Function to render the calendar of a room's bookings from today on. The last modified time is the latest
+# update of the bookings it was rendered from, or the time of the render if bookings were only deleted since
+# the previous one, so it only changes when the bookings do.
+async def _renderFeed(room_id, room_name, today, previous):
+    version = roomVersion(room_id)
+    bookings = [booking async for booking in roomBookingsQuery(room_id, today).stream()]
+
+    last_modified = max((booking.update_time for booking in bookings), default=datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc))
+    last_modified = last_modified.replace(microsecond=0)
+    # the stamp is part of the body, so it is tied to the bookings too and the ETag stays the same between renders
+    stamp = last_modified.strftime('%Y%m%dT%H%M%SZ')
+    events = [icsEvent(room_id, booking.to_dict(), stamp) for booking in bookings]
+    feed = RoomFeed(icsHeader(room_name) + ''.join(events) + ICS_FOOTER, last_modified, today, version)
+    if previous is not None and feed.etag != previous.etag and feed.last_modified <= previous.last_modified:
+        feed.last_modified = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    return feed
+
+# Function to get the calendar feed of a room, rendered at most once per change, per day and per FEED_MAX_AGE
+async def getRoomFeed(room_id, room_name):
+    today = datetime.date.today().isoformat()
+    feed = _feeds.get(room_id)
+    if feed is None or feed.version != roomVersion(room_id) or feed.date != today or feed.expires < time.monotonic():
+        feed = await _renderFeed(room_id, room_name, today, feed)
+        _feeds[room_id] = feed
+    return feed
+
+# Function to check the conditional headers of a request against a feed, True if the poller's copy is still current
+def notModified(feed, if_none_match, if_modified_since):
+    if if_none_match is not None:
+        return feed.etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+    if if_modified_since is not None:
+        try:
+            return feed.last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
@@ -0,0 +1,63 @@
+import time
+from collections import OrderedDict
+import jinja2
+from markupsafe import Markup
+
+# Number of rendered fragments kept
+FRAGMENT_CACHE_SIZE = 512
+
+# Seconds a room's bookings table is reused for. Bookings made through this process change the room's version
+# right away, this only bounds how long changes made by other instances take to show up.
+ROOM_TABLE_MAX_AGE = 60
+
+class FragmentCache:
+    """Rendered template fragments, least recently used first.
+
+    Keys hold the fragment, what it was rendered for and the version of the data it shows (the room
+    catalog version for room lists, the room's version for booking tables), so a fragment is never
+    served after its data changed in this process. Entries can also be given a maximum age, for data
+    that other instances may change.
+    """
+
+    def __init__(self, size=FRAGMENT_CACHE_SIZE):
+        self._size = size
+        self._fragments = OrderedDict()
+
+    def get(self, key):
+        entry = self._fragments.get(key)
+        if entry is None:
+            return None
+        html, expires = entry
+        if expires is not None and expires < time.monotonic():
+            del self._fragments[key]
+            return None
+        self._fragments.move_to_end(key)
+        return html
+
+    def put(self, key, html, max_age=None):
+        self._fragments[key] = (html, time.monotonic() + max_age if max_age is not None else None)
+        self._fragments.move_to_end(key)
+        if len(self._fragments) > self._size:
+            self._fragments.popitem(last=False)
+
+    # Function to render templates/fragments/<name> with the given arguments, or reuse the rendering for the same key
+    def render(self, environment, name, key, max_age=None, **arguments):
+        html = self.get(key)
+        if html is None:
+            html = Markup(environment.get_template(f"fragments/{name}").render(**arguments))
+            self.put(key, html, max_age)
+        return html
+
+fragment_cache = FragmentCache()
+
+def _frozen(value):
+    return tuple(value) if isinstance(value, list) else value
+
+# Template global to include a fragment that only depends on its arguments and on `version`, for example
+#     {{ cachedFragment('room-options.html', room_catalog.version, rooms=rooms) }}
+# URLs in fragments are absolute, so the key includes the base URL of the request as well.
+@jinja2.pass_context
+def cachedFragment(context, name, version, **arguments):
+    request = context['request']
+    key = (name, version, str(request.base_url)) + tuple((argument, _frozen(value)) for argument, value in sorted(arguments.items()))
+    return fragment_cache.render(context.environment, name, key, request=request, **arguments)
@@ -0,0 +1,93 @@
+import bisect
+import datetime
+
+# Bookings can be made between these times, same as the limits of the booking forms
+DAY_START = '07:00'
+DAY_END = '23:00'
+
+# Functions to convert between "HH:MM" strings and minutes since midnight
+def toMinutes(time):
+    hours, minutes = time.split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+
+def toTime(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+# Function to check a string is a time in the "HH:MM" form of the booking forms
+def isTime(value):
+    try:
+        datetime.time.fromisoformat(value)
+    except (TypeError, ValueError):
+        return False
+    return len(value) == 5 and value[2] == ':'
+
+# Function to check a string is a date in the "YYYY-MM-DD" form, YYYYMMDD parses too but booking ids need the dashes
+def isDate(value):
+    try:
+        datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return False
+    return len(value) == 10
+
+# Function to get the error message for a new booking that overlaps `clash`
+def clashMessage(clash):
+    return f"The room is already booked in this time slot: {clash['name']}, {clash['date']}, {clash['room']}, from {clash['from']} to {clash['to']}"
+
+class DaySchedule:
+    """The bookings of one room on one day, kept sorted by start time.
+
+    Bookings on a room never overlap, so when they are sorted by start time their end times are
+    sorted as well. That makes the only booking that can overlap a new slot the last one starting
+    before the slot ends, which binary search finds in O(log n).
+    """
+
+    def __init__(self, bookings=()):
+        self._starts = []
+        self._bookings = []
+        for booking in sorted(bookings, key=lambda booking: booking['from']):
+            self._starts.append(toMinutes(booking['from']))
+            self._bookings.append(booking)
+
+    def __len__(self):
+        return len(self._bookings)
+
+    def __iter__(self):
+        return iter(self._bookings)
+
+    # Function to get the bookings as a list, sorted by start time
+    def bookings(self):
+        return list(self._bookings)
+
+    # Function to find the booking that overlaps the slot from start to end, returns None if the slot is free
+    def conflict(self, start, end):
+        index = bisect.bisect_left(self._starts, toMinutes(end))
+        if index and toMinutes(self._bookings[index - 1]['to']) > toMinutes(start):
+            return self._bookings[index - 1]
+        return None
+
+    # Function to add a booking, raises ValueError if it overlaps an existing booking
+    def insert(self, booking):
+        clash = self.conflict(booking['from'], booking['to'])
+        if clash is not None:
+            raise ValueError(clashMessage(clash))
+        start = toMinutes(booking['from'])
+        index = bisect.bisect_left(self._starts, start)
+        self._starts.insert(index, start)
+        self._bookings.insert(index, booking)
+
+    # Function to find the earliest free slot of the given length in minutes that starts at or after `after`,
+    # returns a (from, to) tuple of "HH:MM" strings or None if the day has no such gap left
+    def nextFreeSlot(self, duration, after=DAY_START, until=DAY_END):
+        start = max(toMinutes(after), toMinutes(DAY_START))
+        index = bisect.bisect_right(self._starts, start)
+        # the booking starting before `after` may still be running
+        if index and toMinutes(self._bookings[index - 1]['to']) > start:
+            start = toMinutes(self._bookings[index - 1]['to'])
+        for booking in self._bookings[index:]:
+            if self._starts[index] - start >= duration:
+                break
+            start = max(start, toMinutes(booking['to']))
+            index += 1
+        if start + duration > toMinutes(until):
+            return None
+        return toTime(start), toTime(start + duration)
@@ -0,0 +1,197 @@
+import asyncio
+import datetime
+import json
+import threading
+from fastapi import APIRouter, Depends, Request, HTTPException
+from fastapi.responses import StreamingResponse
+from auth import getUserToken
+from catalog import room_catalog
+from database import roomBookingsQuery
+from storage import listenerClient
+
+# Events a browser can fall behind by before its queue is dropped and it is told to reload instead
+LIVE_QUEUE_SIZE = 100
+
+# Seconds between comments sent on idle streams, so proxies don't close them
+KEEPALIVE_SECONDS = 15
+
+# Function to get the fields of a booking sent to browsers, the same ones the room page shows
+def _bookingFields(booking):
+    return {'name': booking['name'], 'from': booking['from'], 'to': booking['to']}
+
+class RoomWatch:
+    """One snapshot listener on the bookings of a room, shared by every browser viewing the room.
+
+    Bookings are documents of their own, so the changes Firestore pushes are already the bookings
+    that were added and removed. They are sent to subscribers grouped by date.
+    """
+
+    def __init__(self, hub, room_id):
+        self._hub = hub
+        self._room_id = room_id
+        self._ready = False
+        self._lock = threading.Lock()
+        self.subscribers = set()
+        self._watch = None
+        # start() and stop() run in worker threads, a watch stopped before it started is never started
+        self._start_lock = threading.Lock()
+        self._stopped = False
+
+    # Only bookings from today on are watched, past bookings don't change and the first snapshot would read them all
+    def start(self):
+        today = datetime.date.today().isoformat()
+        with self._start_lock:
+            if not self._stopped:
+                self._watch = roomBookingsQuery(self._room_id, today, client=listenerClient()).on_snapshot(self._onSnapshot)
+
+    # Blocks until the listener's thread has finished, for up to a second
+    def stop(self):
+        with self._start_lock:
+            self._stopped = True
+            watch, self._watch = self._watch, None
+        if watch is not None:
+            watch.unsubscribe()
+
+    # Called from the listener's thread with the bookings that changed. The first snapshot is skipped,
+    # the pages being watched were rendered from the same bookings.
+    def _onSnapshot(self, documents, changes, read_time):
+        days = {}
+        for change in changes:
+            # booking ids are "<room id>_<date>_<start time>", removed documents come without their data
+            date = change.document.id.split('_')[1]
+            day = days.setdefault(date, {'date': date, 'added': [], 'removed': []})
+            if change.type.name != 'ADDED':
+                start = change.document.id.split('_')[2]
+                day['removed'].append({'from': f"{start[:2]}:{start[2:]}"})
+            if change.type.name != 'REMOVED':
+                day['added'].append(_bookingFields(change.document.to_dict()))
+        with self._lock:
+            if not self._ready:
+                self._ready = True
+                return
+            subscribers = list(self.subscribers)
+        for date in sorted(days):
+            self._hub.publish(subscribers, ('bookings', days[date]))
+
+class LiveHub:
+    """Fans the changes of rooms and bookings out to the event streams of connected browsers.
+
+    There is at most one listener per room, started with its first subscriber and stopped with its
+    last one, and the room list comes from the room catalog's own listener. Events are handed from
+    the listeners' threads to the event loop and queued per subscriber.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._rooms = {}
+        self._room_list = set()
+        self._lock = threading.Lock()
+        # separate from the lock of the room listeners, the catalog calls in with its own lock held
+        self._room_list_lock = threading.Lock()
+
+    def start(self, loop):
+        self._loop = loop
+        room_catalog.subscribe(self._roomsChanged)
+
+    def stop(self):
+        room_catalog.unsubscribe(self._roomsChanged)
+        with self._lock:
+            watches = list(self._rooms.values())
+            self._rooms.clear()
+        for watch in watches:
+            watch.stop()
+
+    # Function to queue an event for subscribers, safe to call from any thread
+    def publish(self, subscribers, event):
+        for queue in subscribers:
+            self._loop.call_soon_threadsafe(self._deliver, queue, event)
+
+    # Runs on the event loop. A subscriber that is too far behind gets its queue replaced by a reload event.
+    @staticmethod
+    def _deliver(queue, event):
+        if queue.full():
+            while not queue.empty():
+                queue.get_nowait()
+            event = ('reload', {})
+        queue.put_nowait(event)
+
+    def _roomsChanged(self, added, removed):
+        with self._room_list_lock:
+            subscribers = list(self._room_list)
+        self.publish(subscribers, ('rooms', {'added': added, 'removed': removed}))
+
+    def subscribeRooms(self):
+        queue = asyncio.Queue(LIVE_QUEUE_SIZE)
+        with self._room_list_lock:
+            self._room_list.add(queue)
+        return queue
+
+    def unsubscribeRooms(self, queue):
+        with self._room_list_lock:
+            self._room_list.discard(queue)
+
+    # Function to subscribe to the bookings of a room, starting the room's listener if nobody was watching it yet.
+    # Starting the listener can block on the network, it is done without the lock that the event loop takes.
+    def subscribeRoom(self, room_id):
+        queue = asyncio.Queue(LIVE_QUEUE_SIZE)
+        with self._lock:
+            watch = self._rooms.get(room_id)
+            created = watch is None
+            if created:
+                watch = self._rooms[room_id] = RoomWatch(self, room_id)
+            with watch._lock:
+                watch.subscribers.add(queue)
+        if created:
+            watch.start()
+        return queue
+
+    def unsubscribeRoom(self, room_id, queue):
+        with self._lock:
+            watch = self._rooms.get(room_id)
+            if watch is None:
+                return
+            with watch._lock:
+                watch.subscribers.discard(queue)
+                if watch.subscribers:
+                    return
+            del self._rooms[room_id]
+        # this runs on the event loop, stopping a listener joins its thread
+        self._loop.run_in_executor(None, watch.stop)
+
+live_hub = LiveHub()
+
+# Function to send the events of a queue as a server-sent event stream, `unsubscribe` is called when the browser goes away
+async def _eventStream(queue, unsubscribe):
+    try:
+        yield f"retry: {KEEPALIVE_SECONDS * 1000}\n\n"
+        while True:
+            try:
+                event, data = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    finally:
+        unsubscribe()
+
+# Streaming responses must not be buffered by proxies
+STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+router = APIRouter(prefix='/live', dependencies=[Depends(getUserToken)])
+
+@router.get('/rooms')
+async def liveRooms(request: Request):
+    """Streams the rooms that are added and removed, as `rooms` events with the added and removed names."""
+    queue = live_hub.subscribeRooms()
+    return StreamingResponse(_eventStream(queue, lambda: live_hub.unsubscribeRooms(queue)), media_type='text/event-stream', headers=STREAM_HEADERS)
+
+@router.get('/rooms/{room}')
+async def liveRoom(request: Request, room: str):
+    """Streams the bookings that are added to and removed from a room, as `bookings` events with the date,
+    the added bookings and the start times of the removed ones. A `reload` event means some changes were dropped."""
+    room_entry = room_catalog.get(room)
+    if room_entry is None:
+        raise HTTPException(status_code=404, detail='Room not found')
+    # starting a listener can block on the network
+    queue = await asyncio.to_thread(live_hub.subscribeRoom, room_entry.id)
+    return StreamingResponse(_eventStream(queue, lambda: live_hub.unsubscribeRoom(room_entry.id, queue)), media_type='text/event-stream', headers=STREAM_HEADERS)
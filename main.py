@@ -1,75 +1,94 @@
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-import google.oauth2.id_token
-from google.auth.transport import requests
 import starlette.status as status
-from google.cloud import firestore
-from google.cloud.firestore_v1.base_query import FieldFilter, Or
+import google.auth.exceptions
+from google.cloud.firestore_v1.transforms import ArrayUnion
 import datetime
+import asyncio
+import api
+import live
+from database import firestore_db, roomBookingsQuery, getUserBookings
+from catalog import Room, room_catalog
+from intervals import toMinutes
+from booking import validateBooking, createBooking, createRecurringBooking, cancelBooking, RoomNotFound, BookingConflict, RecurringConflict, InvalidRecurrence, BookingAborted, booking_metrics, room_retries, room_aborts
+from feeds import getRoomFeed, notModified, newCalendarKey, calendarKeyMatches
+from fragments import fragment_cache, cachedFragment, ROOM_TABLE_MAX_AGE
+from versions import roomVersion
+from roomdeletion import startRoomDeletion, RoomHasBookings, RoomDeletionAborted
+from usernames import claimUsername, validateUsername, UsernameTaken, UsernameAborted
+import metrics
+import admission
+from auth import LoginRequired, getUserToken, getCurrentUser, refreshCerts
 
 # define the app that will contain all of our routing for Fast API
 app = FastAPI()
 
-# Initialize Firestore client for database operations
-firestore_db = firestore.Client()
-
-# Set up request adapter for Firebase authentication
-firebase_request_adapter = requests.Request()
-
 # Define the static and templates directories
 app.mount('/static', StaticFiles(directory='static'), name='static')
 templates = Jinja2Templates(directory="templates")
+templates.env.template_class = metrics.TimedTemplate
+templates.env.globals['room_catalog'] = room_catalog
+templates.env.globals['cachedFragment'] = cachedFragment
 
-# Function to retrieve user data from Firestore or create a default user if not found
-def getUser(user_token):
-    user = firestore_db.collection('users').document(user_token['user_id'])
-    if not user.get().exists:
-        user_data = {
-            "username": '',
-            "rooms_list": []
-        }
-        firestore_db.collection('users').document(user_token['user_id']).set(user_data)
-    return user
+# JSON API, see api.py
+app.include_router(api.router)
 
-# Function to validate Firebase ID token and retrieve user information
-def validateFirebaseToken(id_token):
-    if not id_token:
-        return None
-    
-    user_token = None
+# Server-sent events with the changes of rooms and bookings, see live.py
+app.include_router(live.router)
+
+# Admit requests through a bounded queue by the priority of their route and turn away the excess, see admission.py
+app.middleware('http')(admission.admitRequest)
+
+# Time every request and account its Firestore round trips to its route, exposed on /metrics
+app.middleware('http')(metrics.instrumentRequest)
+
+# Fetch the token signing certificates once at startup, they are refreshed in the background afterwards.
+# The room catalog is filled from the rooms collection and kept up to date by its snapshot listener.
+@app.on_event("startup")
+async def startup():
+    await asyncio.to_thread(room_catalog.start)
+    live.live_hub.start(asyncio.get_running_loop())
     try:
-        user_token = google.oauth2.id_token.verify_firebase_token(id_token, firebase_request_adapter)
-    except ValueError as err:
+        await refreshCerts()
+    except google.auth.exceptions.TransportError as err:
         print(str(err))
 
-    return user_token
+@app.on_event("shutdown")
+async def shutdown():
+    live.live_hub.stop()
+    room_catalog.stop()
+
+# Requests without a valid login get the main page with empty data as we will show the login box
+@app.exception_handler(LoginRequired)
+async def loginRequired(request: Request, exc: LoginRequired):
+    if request.url.path.startswith(('/api/', '/live/')):
+        return JSONResponse({'detail': 'Not authenticated'}, status_code=status.HTTP_401_UNAUTHORIZED)
+    context = dict(
+        request=request,
+        user_token=None,
+        errors=None,
+        user_info=None
+    )
+    return templates.TemplateResponse('main.html', context=context)
+
+# Function to add the next free slot of the same length to a booking conflict error message
+def freeSlotHint(errors, schedule, booking):
+    duration = toMinutes(booking['to']) - toMinutes(booking['from'])
+    slot = schedule.nextFreeSlot(duration, booking['from'])
+    if slot:
+        errors += f". The next free slot is from {slot[0]} to {slot[1]}"
+    return errors
 
 # Route for the main page, handling user and guest authentication
 @app.get("/", response_class=HTMLResponse)
-async def root(request: Request):
-    # Query firebase for the request token. An error message is set in case we want to output an error to 
-    # the user in the template.
-    id_token = request.cookies.get("token")
+async def root(request: Request, user_token: dict = Depends(getUserToken), user = Depends(getCurrentUser)):
+    # The user token and document are provided by the dependencies, guests are shown the login box by
+    # the LoginRequired handler. An error message is set in case we want to output an error to the user in the template.
     errors: str | None = None
-    user_token = None
-    user = None
-
-    user_token = validateFirebaseToken(id_token)
 
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=None,
-            errors=errors,
-            user_info=None
-        )
-        return templates.TemplateResponse('main.html', context=context)
-    
-    user = getUser(user_token).get()
-    rooms = [room.get("name") for room in firestore_db.collection('rooms').stream()]
+    rooms = room_catalog.names()
     context = dict(
         request=request,
         user_token=user_token,
@@ -80,26 +99,9 @@ async def root(request: Request):
     return templates.TemplateResponse('main.html', context=context)
 
 @app.get('/set-username', response_class=HTMLResponse)
-async def setUsername(request: Request):
+async def setUsername(request: Request, user_token: dict = Depends(getUserToken), user = Depends(getCurrentUser)):
     """Route (GET) for setting the username when a user logs in for the first time."""
-    id_token = request.cookies.get("token")
     errors: str | None = None
-    user_token = None
-    user = None
-
-    user_token = validateFirebaseToken(id_token)
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=None,
-            errors=errors,
-            user_info=None
-        )
-        return templates.TemplateResponse('main.html', context=context)
-    
-    user = getUser(user_token).get()
 
     context = dict(
         request=request,
@@ -111,23 +113,25 @@ async def setUsername(request: Request):
     return templates.TemplateResponse('set-username.html', context=context)
 
 @app.post('/set-username', response_class=HTMLResponse)
-async def setUsername(request: Request):
+async def setUsername(request: Request, user_token: dict = Depends(getUserToken), user = Depends(getCurrentUser)):
     """Route (POST) for setting the username.
     
     If the username is taken, redisplay the form with the error message.
     """
-    id_token = request.cookies.get("token")
-    user_token = None
     errors: str | None = None
 
-    user_token = validateFirebaseToken(id_token)
-
     form = await request.form()
 
-    user_exists = firestore_db.collection("users").where(filter=FieldFilter('username', '==', form['username'])).get()
-    
-    if user_exists:
-        errors = 'This username is already taken.'
+    errors = validateUsername(form['username'])
+    if errors is None:
+        try:
+            await claimUsername(user.reference, form['username'])
+        except UsernameTaken:
+            errors = 'This username is already taken.'
+        except UsernameAborted:
+            errors = 'The username could not be saved, please try again.'
+
+    if errors:
         context = dict(
             request=request,
             user_token=None,
@@ -135,47 +139,28 @@ async def setUsername(request: Request):
             user_info=None
         )
         return templates.TemplateResponse('set-username.html', context=context)
-    
-    firestore_db.collection('users').document(user_token['user_id']).update({"username": form["username"]})
+
     return RedirectResponse("/", status_code=status.HTTP_302_FOUND)
 
 @app.post("/add-room", response_class=RedirectResponse)
-async def addRoom(request: Request):
+async def addRoom(request: Request, user_token: dict = Depends(getUserToken), user = Depends(getCurrentUser)):
     """Gets the data from the form and adds it to Firestore."""
-    id_token = request.cookies.get("token")
-    user_token = None
-    user = None
     errors: str | None = None
-
-    user_token = validateFirebaseToken(id_token)
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=None,
-            errors=errors,
-            user_info=None
-        )
-        return templates.TemplateResponse('main.html', context=context)
     
     # get form data from the html page
     form = await request.form()
-
-    user = getUser(user_token)
     
-    # rooms are linked to users via keys. Get list of rooms for that user, add the new room to list, then update the list under user
-    rooms = user.get().get('rooms_list')
-    rooms_list = [room.get("name") for room in firestore_db.collection('rooms').stream()]
-    
-    if form["roomName"] not in rooms_list:
-        # create a transaction object and the document reference object, then set the data and commit to save
-        transaction = firestore_db.transaction()
+    if form["roomName"] not in room_catalog:
+        # create a batch object and the document reference object, then set the data and commit to save.
+        # rooms are linked to users via keys, the new room is added to the user's list in the same batch. The list
+        # is changed with an array union, so rooms added or deleted at the same time are not lost or brought back.
+        batch = firestore_db.batch()
         rooms_ref = firestore_db.collection('rooms').document()
-        transaction.set(rooms_ref, {'name': form['roomName'], 'days':[], 'owner': user_token['email'], 'user_id': user.id, 'date_created': str(datetime.date.today())})
-        transaction.commit()
-        rooms.append(rooms_ref)
-        user.update({'rooms_list': rooms})
+        room_data = {'name': form['roomName'], 'owner': user_token['email'], 'user_id': user.id, 'date_created': str(datetime.date.today()), 'calendar_key': newCalendarKey()}
+        batch.set(rooms_ref, room_data)
+        batch.update(user.reference, {'rooms_list': ArrayUnion([rooms_ref])})
+        await batch.commit()
+        room_catalog.add(Room(id=rooms_ref.id, name=room_data['name'], owner=room_data['owner'], user_id=room_data['user_id'], date_created=room_data['date_created'], calendar_key=room_data['calendar_key']))
         return RedirectResponse('/', status.HTTP_302_FOUND)
     else:
         errors = "A room with that name already exists"
@@ -184,34 +169,18 @@ async def addRoom(request: Request):
             user_token=user_token,
             errors=errors,
             user_info=user,
-            rooms=[room.get("name") for room in user.get().get('rooms_list')]
+            rooms=room_catalog.namesOf([room.id for room in user.get('rooms_list')])
         )
         return templates.TemplateResponse('main.html', context=context)
 
 @app.get("/book-room", response_class=HTMLResponse)
-async def bookRoom(request: Request, room: str):
+async def bookRoom(request: Request, room: str, user_token: dict = Depends(getUserToken), user = Depends(getCurrentUser)):
     """Returns a form for booking a room.
     
     Args;
         room: the room to be booked, an optional argument.
     """
-    id_token = request.cookies.get("token")
-    user_token = None
-    user = None
     errors: str | None = None
-    min_time = ''
-
-    user_token = validateFirebaseToken(id_token)
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=None,
-            errors=errors,
-            user_info=None
-        )
-        return templates.TemplateResponse('main.html', context=context)
 
     # find the minimum time that should be accepted from the user.
     # if time now is past 7:00 am then provide current time as the minimum value to be accepted
@@ -221,13 +190,12 @@ async def bookRoom(request: Request, room: str):
     else:
         min_time = '07:00'
 
-    user = getUser(user_token)
     # get the related rooms and store their names in a list
     rooms = []
     if room:
         rooms.append(room)
     else:
-        rooms = [room.get("name") for room in firestore_db.collection("rooms").stream()]
+        rooms = room_catalog.names()
 
     context = dict(
         request=request,
@@ -241,172 +209,78 @@ async def bookRoom(request: Request, room: str):
     return templates.TemplateResponse('book-room.html', context=context)
 
 @app.post("/book-room", response_class=RedirectResponse)
-async def bookRoom(request: Request):
+async def bookRoom(request: Request, user_token: dict = Depends(getUserToken), user = Depends(getCurrentUser)):
     """Creates a booking for a room on the specified date."""
-    id_token = request.cookies.get("token")
-    user_token = None
-    user = None
     errors: str | None = None
-
-    user_token = validateFirebaseToken(id_token)
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=None,
-            errors=errors,
-            user_info=None
-        )
-        return templates.TemplateResponse('main.html', context=context)
     
     # get form data from the html page
     form = await request.form()
 
-    rooms = firestore_db.collection("rooms").stream()
-
-    if form["bookingStartTime"] >= form["bookingEndTime"]:
-        rooms_list = [room.get("name") for room in rooms]
-        errors = "Invalid start and end time selected"
-        context = dict(
-            request=request,
-            user_token=user_token,
-            errors=errors,
-            user_info=user,
-            rooms=rooms_list
-        )
-        return templates.TemplateResponse('book-room.html', context=context)
-    
-    if datetime.date.fromisoformat(form['bookingDate']) == datetime.date.today():
-        '''If booking date is today and booking time is past'''
-        if datetime.time.fromisoformat(form['bookingStartTime']) < datetime.time.fromisoformat(datetime.datetime.now().time().isoformat(timespec='minutes')):
-            rooms_list = [room.get("name") for room in rooms]
-            errors = "Select a valid time"
-            context = dict(
-                request=request,
-                user_token=user_token,
-                errors=errors,
-                user_info=user,
-                rooms=rooms_list
-            )
-            return templates.TemplateResponse('book-room.html', context=context)
-
-    user = getUser(user_token)
-
-    try:
-        *_, room_query = firestore_db.collection("rooms").where(filter=FieldFilter('name', '==', form['roomName'])).get()
-    except ValueError:
-        rooms_list = [room.get("name") for room in rooms]
-        errors = "The selected room is no longer available"
+    room = room_catalog.get(form['roomName'])
+    room_booking = {
+        'name': form['eventName'],
+        'date': form['bookingDate'],
+        'room': form['roomName'],
+        'from': form['bookingStartTime'],
+        'to': form['bookingEndTime'],
+        'user': user.id
+    }
+
+    """Validate and save the booking in one transaction.
+
+    The start and end times are checked first (end after start, not in the past).
+    Every booking is its own document, whose id is derived from the room, the date and the start time,
+    so bookings sort by start time. Bookings never overlap, so the only booking that can clash with
+    the new one is the last one that starts before the new booking ends. The transaction reads the
+    room and that booking with one small range query, and writes the new booking and the user's
+    bookings index entry. If another booking in that range commits in the meantime the transaction
+    is retried, so the conflict check always sees every booking that was made before it, while
+    bookings on other times of the same day don't hold each other up.
+    If the clashing booking ends after the new booking starts the user is trying to book a meeting
+    in a time slot that is already booked so we show the error together with the next free slot of
+    the same length.
+    A repeating booking is expanded into its occurrences, which are all checked and written in
+    one transaction. If some of them clash nothing is booked and every clashing date is shown.
+    """
+    errors = validateBooking(room_booking)
+    if not errors:
+        try:
+            if room is None:
+                raise RoomNotFound("The selected room is no longer available")
+            if form.get('repeat'):
+                interval = form.get('repeatInterval') or '1'
+                if not interval.isdecimal():
+                    raise InvalidRecurrence("Invalid recurrence selected")
+                await createRecurringBooking(room.id, room_booking, form['repeat'], int(interval), form.get('repeatUntil') or room_booking['date'])
+            else:
+                await createBooking(room.id, room_booking)
+        except (RoomNotFound, RecurringConflict, InvalidRecurrence) as err:
+            errors = str(err)
+        except BookingConflict as err:
+            errors = freeSlotHint(str(err), err.schedule, room_booking)
+        except BookingAborted:
+            errors = "The room is busy right now, please try again"
+
+    if errors:
         context = dict(
             request=request,
             user_token=user_token,
             errors=errors,
             user_info=user,
-            rooms=rooms_list
+            rooms=room_catalog.names()
         )
         return templates.TemplateResponse('book-room.html', context=context)
 
-    #  get the dates associated with the room
-    dates = [day.get().get('date') for day in room_query.get('days')]
-
-    transaction = firestore_db.transaction()
-    if form["bookingDate"] not in dates:
-        """The day we want to add booking for is not in the room yet.
-        
-        There is no validation to do for bookings since there will be no bookings.
-        Create a ref object for the new day document, build a dict for the booking info,
-        and save it in a transaction.
-        Then update the room's days list to include the new day ref.
-        """
-        days_ref = firestore_db.collection('days').document()
-        room_booking = {
-            'name': form['eventName'],
-            'date': form['bookingDate'],
-            'room': form['roomName'],
-            'from': form['bookingStartTime'],
-            'to': form['bookingEndTime'],
-            'user': user.id
-        }
-        transaction.set(days_ref, {'date': form['bookingDate'], 'room': form['roomName'], 'bookings':[room_booking,]})
-        transaction.commit()
-        days_list = room_query.get("days")
-        days_list.append(days_ref)
-        room_ref = room_query.reference
-        room_ref.update({'days': days_list})
-    else:
-        """The day we want to add booking for is in the room.
-        
-        We do validation for bookings.
-        Iterate through the days in the room, checking if the day matches our target.
-        Once we find a match we iterate through the bookings associated with that day
-        and do two checks to validate the new booking.
-        1. We check if the booking end time given in the form is greater than the start
-        time of the current booking we are iterating over.
-        2. We check if the booking start time given in the form is less than the end
-        time of the current booking we are iterating over.
-        If both the conditions are true then the user is trying to book a meeting in a time
-        slot that is already booked so we raise an exception.
-        If we iterate through the days without raising an exception it means the booking is
-        valid so we follow same steps as above to add it.
-        """
-        days = room_query.get("days")
-        day = days[dates.index(form['bookingDate'])]
-        for booking in day.get().get("bookings"):
-            if form["bookingEndTime"] > booking["from"] and form["bookingStartTime"] < booking["to"]:
-                rooms_list = [room.get("name") for room in rooms]
-                errors = f"The room is already booked in this time slot: {booking['name']}, {booking['date']}, {booking['room']}, from {booking['from']} to {booking['to']}"
-                context = dict(
-                    request=request,
-                    user_token=user_token,
-                    errors=errors,
-                    user_info=user,
-                    rooms=rooms_list
-                )
-                return templates.TemplateResponse('book-room.html', context=context)
-
-            room_booking = {
-                'name': form['eventName'],
-                'date': form['bookingDate'],
-                'room': form['roomName'],
-                'from': form['bookingStartTime'],
-                'to': form['bookingEndTime'],
-                'user': user.id
-            }
-            bookings_list = day.get().get('bookings')
-            bookings_list.append(room_booking)
-            day.update({"bookings": bookings_list})
-        
     return RedirectResponse('/', status.HTTP_302_FOUND)
 
 @app.get('/view-bookings')
-async def viewBookings(request: Request):
+async def viewBookings(request: Request, user_token: dict = Depends(getUserToken), user = Depends(getCurrentUser)):
     """Show all the bookings the user has made on all the rooms."""
-    id_token = request.cookies.get("token")
-    user_token = None
-    user = None
     errors: str | None = None
 
-    user_token = validateFirebaseToken(id_token)
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=None,
-            errors=errors,
-            user_info=None,
-        )
-        return templates.TemplateResponse('main.html', context=context)
-
-    user = getUser(user_token).get()
-    rooms = [room.get("name") for room in firestore_db.collection("rooms").stream()]
+    rooms = room_catalog.names()
 
-    bookings_list = []
-    for day in firestore_db.collection("days").stream():
-        for booking in day.get('bookings'):
-            if booking['user'] == user.id:
-                bookings_list.append(booking)
+    bookings_list = await getUserBookings(user.id)
 
     context = dict(
         request=request,
@@ -419,26 +293,11 @@ async def viewBookings(request: Request):
     return templates.TemplateResponse('view-bookings.html', context=context)
 
 @app.post('/view-bookings')
-async def filterByRoomAndDay(request: Request):
+async def filterByRoomAndDay(request: Request, user_token: dict = Depends(getUserToken), user = Depends(getCurrentUser)):
     """Show all the bookings the user has made on one the rooms."""
-    id_token = request.cookies.get("token")
-    user_token = None
-    user = None
     errors: str | None = None
     room = None
     date = None
-
-    user_token = validateFirebaseToken(id_token)
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=None,
-            errors=errors,
-            user_info=None,
-        )
-        return templates.TemplateResponse('main.html', context=context)
     
     # get form data from the html page
     form = await request.form()
@@ -452,29 +311,9 @@ async def filterByRoomAndDay(request: Request):
     except KeyError:
         pass
 
-    user = getUser(user_token).get()
-
-    rooms = [room.get("name") for room in firestore_db.collection("rooms").stream()]
-    bookings_list = []
-    if date:
-        for day in firestore_db.collection("days").where(filter=FieldFilter('date', '==', date)).stream():
-            for booking in day.get('bookings'):
-                if room:
-                    if booking['user'] == user.id and booking['room'] == room:
-                        bookings_list.append(booking)
-                else:
-                    bookings_list.append(booking)
-    elif room:
-        for day in firestore_db.collection("days").stream():
-            for booking in day.get('bookings'):
-                if booking['user'] == user.id and booking['room'] == room:
-                        bookings_list.append(booking)
-    else:
-        for day in firestore_db.collection("days").stream():
-            for booking in day.get('bookings'):
-                if booking['user'] == user.id:
-                    bookings_list.append(booking)
-    
+    rooms = room_catalog.names()
+    bookings_list = await getUserBookings(user.id, room, date)
+
     context = dict(
         request=request,
         user_token=user_token,
@@ -486,45 +325,34 @@ async def filterByRoomAndDay(request: Request):
     return templates.TemplateResponse('view-bookings.html', context=context)
 
 @app.post('/delete-booking')
-async def deleteBooking(request: Request):
+async def deleteBooking(request: Request, user_token: dict = Depends(getUserToken), user = Depends(getCurrentUser)):
     """Delete a booking."""
-    id_token = request.cookies.get("token")
-    user_token = None
-    user = None
     errors: str | None = None
+    
+    # get form data from the html page
+    form = await request.form()
 
-    user_token = validateFirebaseToken(id_token)
+    room = room_catalog.get(form['room'])
+    if room is not None:
+        try:
+            await cancelBooking(room.id, room.name, form['date'], form['from'], form['to'], user.id)
+        except BookingAborted:
+            errors = "The room is busy right now, please try again"
 
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
+    if errors:
         context = dict(
             request=request,
-            user_token=None,
+            user_token=user_token,
             errors=errors,
-            user_info=None,
+            user_info=user,
+            rooms=room_catalog.namesOf([room.id for room in user.get('rooms_list')])
         )
         return templates.TemplateResponse('main.html', context=context)
-    
-    # get form data from the html page
-    form = await request.form()
-
-    try:
-        *_, room = firestore_db.collection('rooms').where(filter=FieldFilter('name', '==', form['room'])).get()
-    except ValueError:
-        pass
-
-    for day in room.get('days'):
-        if day.get().get('date') == form['date']:
-            bookings = day.get().get('bookings')
-            for index, value in enumerate(bookings):
-                if value.get("from") == form['from'] and value.get("to") == form['to']:
-                    del bookings[index]
-            day.update({'bookings': bookings})
 
     return RedirectResponse('/', status.HTTP_302_FOUND)
 
 @app.get('/edit-booking')
-async def editBooking(request: Request, booking_room: str, date: str, start: str, end: str, ):
+async def editBooking(request: Request, booking_room: str, date: str, start: str, end: str, user_token: dict = Depends(getUserToken), user = Depends(getCurrentUser)):
     """Edit a booking.
     
     Why delete a booking first when updating? A lot of information can change when a booking is updated,
@@ -532,29 +360,12 @@ async def editBooking(request: Request, booking_room: str, date: str, start: str
     and room then update it in the new day and room. Considering this is a possibility then it does no harm
     to delete the booking right away an update is initiated, then recreate a new booking with the new information.
     """
-    id_token = request.cookies.get("token")
-    user_token = None
-    user = None
     errors: str | None = None
-
-    user_token = validateFirebaseToken(id_token)
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=None,
-            errors=errors,
-            user_info=None,
-        )
-        return templates.TemplateResponse('main.html', context=context)
     
     # get form data from the html page
     #form = await request.form()
 
-    user = getUser(user_token).get()
-
-    rooms = [room.get("name") for room in firestore_db.collection("rooms").stream()]
+    rooms = room_catalog.names()
 
     # find the minimum time that should be accepted from the user.
     # if time now is past 7:00 am then provide current time as the minimum value to be accepted
@@ -564,262 +375,188 @@ async def editBooking(request: Request, booking_room: str, date: str, start: str
     else:
         min_time = '07:00'
 
-    *_, room = firestore_db.collection("rooms").where(filter=FieldFilter('name', '==', booking_room)).get()
-    for day in room.get('days'):
-        if day.get().get('date') == date:
-            bookings = day.get().get('bookings')
-            for index, value in enumerate(bookings):
-                if value.get("from") == start and value.get("to") == end:
-                    booking = {
-                        'event': bookings[index].get('name'),
-                        'date': bookings[index].get('date'),
-                        'room': bookings[index].get('room'),
-                        'from': bookings[index].get('from'),
-                        'to': bookings[index].get('to')
-                    }
-                    del bookings[index]
-                    day.update({'bookings': bookings})
-                    context = dict(
-                        request=request,
-                        user_token=user_token,
-                        errors=errors,
-                        user_info=user,
-                        booking=booking,
-                        rooms=rooms,
-                        min_time=min_time
-                    )
-                    return templates.TemplateResponse('edit-booking.html', context=context)
-
-@app.post('/edit-booking')
-async def editBooking(request: Request):
-    """Edit a booking."""
-    id_token = request.cookies.get("token")
-    user_token = None
-    user = None
-    errors: str | None = None
-
-    user_token = validateFirebaseToken(id_token)
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
+    room = room_catalog.get(booking_room)
+    value = None
+    if room is not None:
+        try:
+            value = await cancelBooking(room.id, room.name, date, start, end, user.id)
+        except BookingAborted:
+            errors = "The room is busy right now, please try again"
+    if errors:
         context = dict(
             request=request,
-            user_token=None,
+            user_token=user_token,
             errors=errors,
-            user_info=None,
+            user_info=user,
+            rooms=room_catalog.namesOf([room.id for room in user.get('rooms_list')])
         )
         return templates.TemplateResponse('main.html', context=context)
-    
-    # get form data from the html page
-    form = await request.form()
-
-    rooms = firestore_db.collection("rooms").stream()
-
-    if form["bookingStartTime"] >= form["bookingEndTime"]:
-        rooms_list = [room.get("name") for room in rooms]
-        errors = "Invalid start and end time selected"
+    if value is not None:
+        booking = {
+            'event': value.get('name'),
+            'date': value.get('date'),
+            'room': value.get('room'),
+            'from': value.get('from'),
+            'to': value.get('to')
+        }
         context = dict(
             request=request,
             user_token=user_token,
             errors=errors,
             user_info=user,
-            rooms=rooms_list
+            booking=booking,
+            rooms=rooms,
+            min_time=min_time
         )
-        return templates.TemplateResponse('book-room.html', context=context)
+        return templates.TemplateResponse('edit-booking.html', context=context)
 
-    if datetime.date.fromisoformat(form['bookingDate']) == datetime.date.today():
-        '''If booking date is today and booking time is past'''
-        if datetime.time.fromisoformat(form['bookingStartTime']) < datetime.time.fromisoformat(datetime.datetime.now().time().isoformat(timespec='minutes')):
-            rooms_list = [room.get("name") for room in rooms]
-            errors = "Select a valid time"
-            context = dict(
-                request=request,
-                user_token=user_token,
-                errors=errors,
-                user_info=user,
-                rooms=rooms_list
-            )
-            return templates.TemplateResponse('book-room.html', context=context)
-
-    user = getUser(user_token).get()
+@app.post('/edit-booking')
+async def editBooking(request: Request, user_token: dict = Depends(getUserToken), user = Depends(getCurrentUser)):
+    """Edit a booking."""
+    errors: str | None = None
+    
+    # get form data from the html page
+    form = await request.form()
 
-    try:
-        *_, room_query = firestore_db.collection("rooms").where(filter=FieldFilter('name', '==', form['roomName'])).get()
-    except ValueError:
-        rooms_list = [room.get("name") for room in rooms]
-        errors = "The selected room is no longer available"
+    room = room_catalog.get(form['roomName'])
+    room_booking = {
+        'name': form['eventName'],
+        'date': form['bookingDate'],
+        'room': form['roomName'],
+        'from': form['bookingStartTime'],
+        'to': form['bookingEndTime'],
+        'user': user.id
+    }
+
+    # validate and save the booking in one transaction, same as bookRoom
+    errors = validateBooking(room_booking)
+    if not errors:
+        try:
+            if room is None:
+                raise RoomNotFound("The selected room is no longer available")
+            await createBooking(room.id, room_booking)
+        except RoomNotFound as err:
+            errors = str(err)
+        except BookingConflict as err:
+            errors = freeSlotHint(str(err), err.schedule, room_booking)
+        except BookingAborted:
+            errors = "The room is busy right now, please try again"
+
+    if errors:
         context = dict(
             request=request,
             user_token=user_token,
             errors=errors,
             user_info=user,
-            rooms=rooms_list
+            rooms=room_catalog.names()
         )
         return templates.TemplateResponse('book-room.html', context=context)
-
-    # validation for day and bookings
-    dates = [day.get().get('date') for day in room_query.get('days')]
-
-    transaction = firestore_db.transaction()
-    if form["bookingDate"] not in dates:
-        days_ref = firestore_db.collection('days').document()
-        room_booking = {
-            'name': form['eventName'],
-            'date': form['bookingDate'],
-            'room': form['roomName'],
-            'from': form['bookingStartTime'],
-            'to': form['bookingEndTime'],
-            'user': user.id
-        }
-        transaction.set(days_ref, {'date': form['bookingDate'], 'bookings':[room_booking,]})
-        transaction.commit()
-        days_list = room_query.get("days")
-        days_list.append(days_ref)
-        room_ref = room_query.reference
-        room_ref.update({'days': days_list})
-    else:
-        days = room_query.get("days")
-        day = days[dates.index(form['bookingDate'])]
-        for booking in day.get().get("bookings"):
-            if form["bookingEndTime"] > booking["from"] and form["bookingStartTime"] < booking["to"]:
-                rooms_list = [room.get("name") for room in rooms]
-                errors = f"The room is already booked in this time slot: {booking['name']}, {booking['date']}, {booking['room']}, from {booking['from']} to {booking['to']}"
-                context = dict(
-                    request=request,
-                    user_token=user_token,
-                    errors=errors,
-                    user_info=user,
-                    rooms=rooms_list
-                )
-                return templates.TemplateResponse('book-room.html', context=context)
-
-        room_booking = {
-            'name': form['eventName'],
-            'date': form['bookingDate'],
-            'room': form['roomName'],
-            'from': form['bookingStartTime'],
-            'to': form['bookingEndTime'],
-            'user': user.id
-        }
-        bookings_list = day.get().get('bookings')
-        bookings_list.append(room_booking)
-        day.update({"bookings": bookings_list})
     return RedirectResponse('/', status.HTTP_302_FOUND)
 
 @app.post('/delete-room')
-async def deleteRoom(request: Request):
-    """Delete a room."""
-    id_token = request.cookies.get("token")
-    user_token = None
-    user = None
-    errors: str | None = None
+async def deleteRoom(request: Request, user_token: dict = Depends(getUserToken), user = Depends(getCurrentUser)):
+    """Delete a room.
 
-    user_token = validateFirebaseToken(id_token)
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=None,
-            errors=errors,
-            user_info=None,
-        )
-        return templates.TemplateResponse('main.html', context=context)
+    The room is gone as soon as this returns, its past bookings are deleted in the background (see roomdeletion.py).
+    """
+    errors: str | None = None
     
     # get form data from the html page
     form = await request.form()
 
-    user = getUser(user_token)
-
-    if form['user'] != user.id:
+    room = room_catalog.get(form['room'])
+    if room is None or room.user_id != user.id:
         errors = 'Rooms can only be deleted by the person who created it.'
+    else:
+        try:
+            await startRoomDeletion(room, user)
+        except (RoomHasBookings, RoomNotFound) as err:
+            errors = str(err)
+        except RoomDeletionAborted:
+            errors = "The room is busy right now, please try again"
+
+    if errors:
         context = dict(
             request=request,
             user_token=user_token,
             errors=errors,
             user_info=user,
-            rooms=[room.get("name") for room in user.get().get('rooms_list')]
+            rooms=room_catalog.namesOf([room.id for room in user.get('rooms_list')])
         )
         return templates.TemplateResponse('main.html', context=context)
 
-    *_, room_query = firestore_db.collection('rooms').where(filter=FieldFilter('name', '==', form['room'])).where(filter=FieldFilter('user_id', '==', form['user'])).get()
-    days = room_query.get('days')
-    
-    for day_index, day in enumerate(days):
-        """Check if the room has bookings associated."""
-        if day.get().get('bookings'):
-            errors = 'Cannot delete room with bookings'
-            context = dict(
-                request=request,
-                user_token=user_token,
-                errors=errors,
-                user_info=user,
-                rooms=[room.get("name") for room in user.get().get('rooms_list')]
-            )
-            return templates.TemplateResponse('main.html', context=context)
-        else:
-            days[day_index].delete()
-            del days[day_index]
-
-    user_rooms = user.get().get('rooms_list')
-    room_names = [room.get().get("name") for room in user_rooms]
-    room_index = room_names.index(form['room'])
-    room_query.reference.update({'days':[]})
-    user_rooms[room_index].delete()
-    del user_rooms[room_index]
-    user.update({'rooms_list': user_rooms})
-
     return RedirectResponse('/', status.HTTP_302_FOUND)
 
+@app.get('/metrics')
+async def prometheusMetrics():
+    """Request, Firestore, token verification and template render metrics in the Prometheus text format."""
+    body, content_type = metrics.exposition()
+    return Response(body, media_type=content_type)
+
+@app.get('/booking-metrics')
+async def bookingMetrics():
+    """Counters of the booking transactions, with the rooms that needed the most retries or aborted the most."""
+    return dict(
+        booking_metrics,
+        hot_rooms=room_retries.most_common(10),
+        aborted_rooms=room_aborts.most_common(10)
+    )
+
+@app.get('/rooms/{room}/calendar.ics')
+async def roomCalendar(request: Request, room: str, key: str | None = None):
+    """iCalendar feed of the upcoming bookings on a room, for calendar clients to subscribe to.
+
+    Calendar clients can't log in, so the feed is served without a login to requests with the room's calendar
+    key, which is part of the feed URL shown on the room's page. Any other request gets a 404.
+    The rendered feed is kept in memory until the room's bookings change, and pollers that send back its
+    ETag or Last-Modified get an empty 304 response as long as it is still current.
+    """
+    room_entry = room_catalog.get(room)
+    if room_entry is None or not calendarKeyMatches(room_entry, key):
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "The selected room is no longer available")
+    feed = await getRoomFeed(room_entry.id, room_entry.name)
+    if notModified(feed, request.headers.get('if-none-match'), request.headers.get('if-modified-since')):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=feed.headers)
+    return Response(feed.body, media_type='text/calendar', headers=feed.headers)
+
 @app.get("/view-room/{room}", response_class=RedirectResponse)
-async def viewRoom(request: Request, room: str):
+async def viewRoom(request: Request, room: str, user_token: dict = Depends(getUserToken), user = Depends(getCurrentUser)):
     """Gets the details of a specified room."""
-    id_token = request.cookies.get("token")
-    user_token = None
-    user = None
     errors: str | None = None
 
-    user_token = validateFirebaseToken(id_token)
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=None,
-            errors=errors,
-            user_info=None,
-        )
-        return templates.TemplateResponse('main.html', context=context)
-
     # get form data from the html page
     # form = await request.form()
 
-    user = getUser(user_token)
-    bookings = []
-    try:
-        *_, room_query = firestore_db.collection('rooms').where(filter=FieldFilter('name', '==', room)).get()
-    except ValueError:
+    room_entry = room_catalog.get(room)
+    if room_entry is None:
         errors = 'The selected room is no longer available.'
         context = dict(
             request=request,
             user_token=user_token,
             errors=errors,
             user_info=user,
-            rooms=[room.get("name") for room in user.get().get('rooms_list')]
+            rooms=room_catalog.namesOf([room.id for room in user.get('rooms_list')])
         )
         return templates.TemplateResponse('main.html', context=context)
 
-    for day in room_query.get("days"):
-        if day.get().get("bookings"):
-            '''Only add to bookings if the list of bookings associated with this day is not empty.'''
-            bookings.append({day.get().get('date'): [item for item in day.get().get("bookings")]})
+    # the bookings table is rendered once per version of the room's bookings, so repeated views
+    # of a room that has not changed skip both the bookings query and the rendering
+    key = ('room-bookings.html', room_entry.id, roomVersion(room_entry.id))
+    bookings_table = fragment_cache.get(key)
+    if bookings_table is None:
+        days = {}
+        # all the bookings of the room are read with one range query on their ids, ordered by date and time
+        async for booking in roomBookingsQuery(room_entry.id).stream():
+            days.setdefault(booking.get('date'), []).append(booking.to_dict())
+        bookings = [{date: day_bookings} for date, day_bookings in days.items()]
+        bookings_table = fragment_cache.render(templates.env, 'room-bookings.html', key, max_age=ROOM_TABLE_MAX_AGE, bookings=bookings)
 
     context = dict(
         request=request,
         user_token=user_token,
         errors=errors,
         user_info=user,
-        room=room_query,
-        bookings=bookings
+        room=room_entry,
+        bookings_table=bookings_table
     )
-    return templates.TemplateResponse('view-room.html', context=context)
\ No newline at end of file
+    return templates.TemplateResponse('view-room.html', context=context)
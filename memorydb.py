@@ -0,0 +1,534 @@
+"""An in-process stand-in for the Firestore async client, for running the app without GCP.
+
+It implements the part of the client API the app uses: documents and sub-collections, get_all,
+queries with filters, ordering, cursors, limits and projections, write batches with preconditions,
+a bulk writer, transactions that are retried when a document or query result they read changed before
+they commit, and snapshot listeners on collections and queries. Data is kept in memory and lost when
+the process exits.
+
+Every call that would be a round trip to Firestore is counted in `operations`, passed to the
+`on_rpc` callback like the round trips of the real client, and awaits for `latency` seconds, so
+the interleaving of concurrent requests is the same as against the real database and the number
+of round trips can be measured.
+"""
+import asyncio
+import copy
+import datetime
+import random
+import string
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
+from google.cloud.firestore_v1.base_document import DocumentSnapshot
+from google.cloud.firestore_v1.base_transaction import _EXCEED_ATTEMPTS_TEMPLATE
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.cloud.firestore_v1.transforms import DELETE_FIELD, ArrayRemove, ArrayUnion, Increment
+
+DOCUMENT_ID = FieldPath.document_id()
+
+# Characters of generated document ids, same as Firestore's auto ids
+_ID_CHARACTERS = string.ascii_letters + string.digits
+
+# Writes sent per batch by the bulk writer, the default of Firestore's BulkWriter
+BULK_BATCH_SIZE = 20
+
+class _Stored:
+    """A document as it is kept in the store."""
+
+    def __init__(self, data, create_time, update_time):
+        self.data = data
+        self.create_time = create_time
+        self.update_time = update_time
+
+class MemoryQuery:
+    """A query on a collection, built up the same way as a Firestore query."""
+
+    def __init__(self, client, path, filters=(), orders=(), count=None, cursor=None, fields=None):
+        self._client = client
+        self._path = path
+        self._filters = filters
+        self._orders = orders
+        self._count = count
+        self._cursor = cursor
+        self._fields = fields
+
+    def _copy(self, **changes):
+        arguments = dict(filters=self._filters, orders=self._orders, count=self._count, cursor=self._cursor, fields=self._fields)
+        arguments.update(changes)
+        return MemoryQuery(self._client, self._path, **arguments)
+
+    def where(self, field_path=None, op_string=None, value=None, *, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction='ASCENDING'):
+        return self._copy(orders=self._orders + ((field_path, direction == 'DESCENDING'),))
+
+    def limit(self, count):
+        return self._copy(count=count)
+
+    def start_after(self, document_fields):
+        return self._copy(cursor=document_fields)
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    # Function to listen to the documents matching the query's filters, see MemoryCollection.on_snapshot
+    def on_snapshot(self, callback):
+        return self._client._listen(self._path, callback, self._filters)
+
+    async def stream(self, transaction=None):
+        for snapshot in await self._client._query(self, transaction):
+            yield snapshot
+
+    async def get(self, transaction=None):
+        return await self._client._query(self, transaction)
+
+class MemoryCollection(MemoryQuery):
+
+    def __init__(self, client, path):
+        super().__init__(client, path)
+
+    @property
+    def id(self):
+        return self._path[-1]
+
+    def document(self, document_id=None):
+        if document_id is None:
+            document_id = ''.join(random.choice(_ID_CHARACTERS) for _ in range(20))
+        return MemoryDocument(self._client, self._path + (document_id,))
+
+    # Function to listen to the documents of the collection, the callback gets the initial snapshot right away
+    # and then every committed change, with the same arguments as a Firestore listener
+    def on_snapshot(self, callback):
+        return self._client._listen(self._path, callback)
+
+class MemoryDocument:
+    """A reference to a document, with the same methods as a Firestore document reference."""
+
+    def __init__(self, client, path):
+        self._client = client
+        self._path = path
+
+    @property
+    def id(self):
+        return self._path[-1]
+
+    @property
+    def path(self):
+        return '/'.join(self._path)
+
+    @property
+    def parent(self):
+        return MemoryCollection(self._client, self._path[:-1])
+
+    def collection(self, collection_id):
+        return MemoryCollection(self._client, self._path + (collection_id,))
+
+    def __eq__(self, other):
+        return isinstance(other, MemoryDocument) and self._path == other._path
+
+    def __hash__(self):
+        return hash(self._path)
+
+    # references stored in documents (like a user's rooms_list) are shared, not copied, when snapshots copy their data
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return f"<MemoryDocument {self.path}>"
+
+    async def get(self, field_paths=None, transaction=None):
+        return (await self._client._read([self], transaction))[0]
+
+    async def create(self, document_data):
+        return await self._write('create', document_data)
+
+    async def set(self, document_data, merge=False):
+        return await self._write('set', document_data, merge=merge)
+
+    async def update(self, field_updates, option=None):
+        return await self._write('update', field_updates, option=option)
+
+    async def delete(self, option=None):
+        return await self._write('delete', None, option=option)
+
+    async def _write(self, kind, data, **options):
+        update_time = await self._client._commit([(kind, self, data, options)])
+        return SimpleNamespace(update_time=update_time)
+
+class _Writes:
+    """Writes collected by a batch or a transaction, applied together when it commits."""
+
+    def _reset(self):
+        self._writes = []
+
+    def create(self, reference, document_data):
+        self._writes.append(('create', reference, document_data, {}))
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(('set', reference, document_data, {'merge': merge}))
+
+    def update(self, reference, field_updates, option=None):
+        self._writes.append(('update', reference, field_updates, {'option': option}))
+
+    def delete(self, reference, option=None):
+        self._writes.append(('delete', reference, None, {'option': option}))
+
+class MemoryBatch(_Writes):
+
+    def __init__(self, client):
+        self._client = client
+        self._reset()
+
+    async def commit(self):
+        update_time = await self._client._commit(self._writes)
+        return [SimpleNamespace(update_time=update_time) for _ in self._writes]
+
+class MemoryBulkWriter(_Writes):
+    """A bulk writer, with the same methods as Firestore's BulkWriter. The writes are sent in batches of
+    BULK_BATCH_SIZE when it is flushed or closed, each batch blocking the calling thread for its round trip."""
+
+    def __init__(self, client):
+        self._client = client
+        self._reset()
+
+    def flush(self):
+        writes = self._writes
+        self._reset()
+        for start in range(0, len(writes), BULK_BATCH_SIZE):
+            self._client._blockingCommit(writes[start:start + BULK_BATCH_SIZE])
+
+    def close(self):
+        self.flush()
+
+class MemoryTransaction(_Writes):
+    """A transaction, see `transactional` for how it commits."""
+
+    def __init__(self, client, max_attempts=5):
+        self._client = client
+        self._max_attempts = max_attempts
+        self._reset()
+
+    def _reset(self):
+        super()._reset()
+        # update time (None for missing documents) of every document read in this attempt, by path
+        self._reads = {}
+        # queries run in this attempt with the update times of their results, a document that starts or stops
+        # matching a query is a change too
+        self._queries = []
+
+# Decorator for functions run in a transaction, the counterpart of firestore.async_transactional.
+# The function is run, and its writes are committed unless a document or query result it read has changed
+# since, in which case it is run again. Raises ValueError after max_attempts runs, like the Firestore client.
+def transactional(function):
+    async def run(transaction, *args, **kwargs):
+        for _ in range(transaction._max_attempts):
+            transaction._reset()
+            result = await function(transaction, *args, **kwargs)
+            if await transaction._client._commit(transaction._writes, transaction._reads, transaction._queries) is not None:
+                return result
+        raise ValueError(_EXCEED_ATTEMPTS_TEMPLATE.format(transaction._max_attempts))
+    return run
+
+_MISSING = object()
+
+# Function to get a field of a document's data, dotted paths reach into maps. Returns _MISSING if there is no such field.
+def _field(data, field_path):
+    value = data
+    for part in field_path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+def _value(document_id, data, field_path):
+    return document_id if field_path == DOCUMENT_ID else _field(data, field_path)
+
+# Function to check a document against the filters of a query
+def _passes(filters, document_id, data):
+    for field_path, op, operand in filters:
+        if isinstance(operand, MemoryDocument):
+            operand = operand.id
+        field_value = _value(document_id, data, field_path)
+        if field_value is _MISSING or not _matches(field_value, op, operand):
+            return False
+    return True
+
+def _matches(value, op, operand):
+    if op == '==':
+        return value == operand
+    if op == '!=':
+        return value != operand
+    if op == 'in':
+        return value in operand
+    if op == 'not-in':
+        return value not in operand
+    if op == 'array_contains':
+        return isinstance(value, list) and operand in value
+    if op == 'array_contains_any':
+        return isinstance(value, list) and any(item in value for item in operand)
+    try:
+        return {'<': value < operand, '<=': value <= operand, '>': value > operand, '>=': value >= operand}[op]
+    except TypeError:
+        return False
+
+class MemoryClient:
+    """The in-memory database, used in place of firestore.AsyncClient (and firestore.Client for listeners)."""
+
+    def __init__(self, latency=0, on_rpc=None):
+        self.latency = latency
+        self.on_rpc = on_rpc
+        self.operations = Counter()
+        # collection path -> document id -> _Stored
+        self._collections = {}
+        self._listeners = {}
+        self._lock = threading.Lock()
+        self._last_time = None
+
+    def collection(self, collection_id):
+        return MemoryCollection(self, (collection_id,))
+
+    def document(self, document_path):
+        return MemoryDocument(self, tuple(document_path.split('/')))
+
+    def batch(self):
+        return MemoryBatch(self)
+
+    def bulk_writer(self):
+        return MemoryBulkWriter(self)
+
+    def transaction(self, max_attempts=5, read_only=False):
+        return MemoryTransaction(self, max_attempts)
+
+    def write_option(self, **kwargs):
+        return kwargs
+
+    async def get_all(self, references, field_paths=None, transaction=None):
+        for snapshot in await self._read(list(references), transaction):
+            yield snapshot
+
+    # Function to count a round trip and wait for it
+    async def _rpc(self, kind, rpc, documents=0, writes=0):
+        started = time.perf_counter()
+        await asyncio.sleep(self.latency)
+        self._counted(kind, rpc, started, documents, writes)
+
+    # Same as _rpc for the bulk writer, whose round trips block the thread that sends them
+    def _blockingRpc(self, kind, rpc, documents=0, writes=0):
+        started = time.perf_counter()
+        time.sleep(self.latency)
+        self._counted(kind, rpc, started, documents, writes)
+
+    def _counted(self, kind, rpc, started, documents, writes):
+        self.operations[kind] += 1
+        self.operations['documents_read'] += documents
+        self.operations['writes'] += writes
+        if self.on_rpc is not None:
+            self.on_rpc(rpc, time.perf_counter() - started, documents=documents, writes=writes)
+
+    def _now(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        # commits are ordered, two of them never get the same update time
+        if self._last_time is not None and now <= self._last_time:
+            now = self._last_time + datetime.timedelta(microseconds=1)
+        self._last_time = now
+        return now
+
+    def _stored(self, path):
+        return self._collections.get(path[:-1], {}).get(path[-1])
+
+    def _snapshot(self, reference, stored, read_time, fields=None):
+        if stored is None:
+            return DocumentSnapshot(reference, None, exists=False, read_time=read_time, create_time=None, update_time=None)
+        data = stored.data
+        if fields is not None:
+            data = {field: value for field, value in data.items() if field in fields}
+        return DocumentSnapshot(reference, copy.deepcopy(data), exists=True, read_time=read_time, create_time=stored.create_time, update_time=stored.update_time)
+
+    async def _read(self, references, transaction=None):
+        await self._rpc('reads', 'get', documents=len(references))
+        with self._lock:
+            read_time = self._now()
+            snapshots = [self._snapshot(reference, self._stored(reference._path), read_time) for reference in references]
+        if transaction is not None:
+            for snapshot in snapshots:
+                transaction._reads.setdefault(snapshot.reference.path, snapshot.update_time)
+        return snapshots
+
+    async def _query(self, query, transaction=None):
+        with self._lock:
+            read_time = self._now()
+            rows = self._rows(query)
+
+        # the round trip is made once the results are known, so it can report how many documents it returned
+        await self._rpc('queries', 'query', documents=len(rows))
+        snapshots = [self._snapshot(MemoryDocument(self, query._path + (document_id,)), stored, read_time, query._fields) for keys, document_id, stored in rows]
+        if transaction is not None:
+            for snapshot in snapshots:
+                transaction._reads.setdefault(snapshot.reference.path, snapshot.update_time)
+            transaction._queries.append((query, self._results(rows)))
+        return snapshots
+
+    # Function to get the (ordering keys, document id, stored document) rows a query returns, called with the lock held
+    def _rows(self, query):
+        # like Firestore, an inequality filter orders by its field first and documents are ordered by id last
+        orders = list(query._orders)
+        ordered = [field_path for field_path, descending in orders]
+        for field_path, op, operand in query._filters:
+            if op in ('<', '<=', '>', '>=', '!=', 'not-in') and field_path not in ordered:
+                orders.insert(0, (field_path, False))
+                ordered.insert(0, field_path)
+        if DOCUMENT_ID not in ordered:
+            orders.append((DOCUMENT_ID, False))
+
+        rows = []
+        for document_id, stored in self._collections.get(query._path, {}).items():
+            keys = [_value(document_id, stored.data, field_path) for field_path, descending in orders]
+            if _MISSING not in keys and _passes(query._filters, document_id, stored.data):
+                rows.append((keys, document_id, stored))
+
+        for index in reversed(range(len(orders))):
+            rows.sort(key=lambda row: row[0][index], reverse=orders[index][1])
+
+        if query._cursor is not None:
+            if isinstance(query._cursor, DocumentSnapshot):
+                cursor = [_value(query._cursor.id, query._cursor._data, field_path) for field_path, descending in orders]
+            else:
+                cursor = [query._cursor[field_path] for field_path, descending in query._orders]
+            rows = [row for row in rows if self._after(row[0], cursor, orders)]
+        if query._count is not None:
+            rows = rows[:query._count]
+        return rows
+
+    @staticmethod
+    def _results(rows):
+        return [(document_id, stored.update_time) for keys, document_id, stored in rows]
+
+    # Function to check if the ordering keys of a document come after the values of a cursor
+    @staticmethod
+    def _after(keys, cursor, orders):
+        for key, position, (field_path, descending) in zip(keys, cursor, orders):
+            if key != position:
+                return (key < position) if descending else (key > position)
+        return False
+
+    # Function to apply writes atomically. Returns the update time, or None without writing anything
+    # if one of the documents in `reads` or the results of one of the `queries` changed since they were read.
+    async def _commit(self, writes, reads=None, queries=()):
+        await self._rpc('commits', 'commit', writes=len(writes))
+        return self._write(writes, reads, queries)
+
+    def _blockingCommit(self, writes):
+        self._blockingRpc('commits', 'batch_write', writes=len(writes))
+        return self._write(writes)
+
+    def _write(self, writes, reads=None, queries=()):
+        with self._lock:
+            if reads:
+                for path, update_time in reads.items():
+                    stored = self._stored(tuple(path.split('/')))
+                    if (stored.update_time if stored else None) != update_time:
+                        return None
+            for query, results in queries:
+                if self._results(self._rows(query)) != results:
+                    return None
+
+            update_time = self._now()
+            # the state of every written document after the writes, checked against preconditions as they are applied
+            staged = {}
+            for kind, reference, data, options in writes:
+                path = reference._path
+                current = staged[path] if path in staged else self._stored(path)
+                option = options.get('option') or {}
+                if 'last_update_time' in option and (current is None or current.update_time != option['last_update_time']):
+                    raise FailedPrecondition(f"{reference.path} has been changed since it was read")
+                if option.get('exists') is False and current is not None:
+                    raise AlreadyExists(f"Document already exists: {reference.path}")
+                if kind == 'create':
+                    if current is not None:
+                        raise AlreadyExists(f"Document already exists: {reference.path}")
+                    staged[path] = _Stored(self._apply({}, data), update_time, update_time)
+                elif kind == 'set':
+                    base = dict(current.data) if current is not None and options.get('merge') else {}
+                    staged[path] = _Stored(self._apply(base, data, merge=options.get('merge')), current.create_time if current else update_time, update_time)
+                elif kind == 'update':
+                    if current is None:
+                        raise NotFound(f"No document to update: {reference.path}")
+                    staged[path] = _Stored(self._apply(copy.deepcopy(current.data), data, dotted=True), current.create_time, update_time)
+                else:
+                    staged[path] = None
+
+            changes = {}
+            for path, stored in staged.items():
+                collection = self._collections.setdefault(path[:-1], {})
+                existed = path[-1] in collection
+                if stored is None:
+                    collection.pop(path[-1], None)
+                    if existed:
+                        changes.setdefault(path[:-1], []).append(('REMOVED', path, None))
+                else:
+                    collection[path[-1]] = stored
+                    changes.setdefault(path[:-1], []).append(('MODIFIED' if existed else 'ADDED', path, stored))
+            self._notify(changes, update_time)
+        return update_time
+
+    # Function to apply the fields of a write to a document's data, update writes take dotted field paths and
+    # merged sets merge nested maps field by field. Increments add to the current value, or start from 0, array
+    # unions append their elements that aren't there yet and array removals drop every element equal to one of theirs.
+    @staticmethod
+    def _apply(data, fields, dotted=False, merge=False):
+        for field_path, value in fields.items():
+            parts = field_path.split('.') if dotted else [field_path]
+            target = data
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            if value is DELETE_FIELD:
+                target.pop(parts[-1], None)
+            elif isinstance(value, Increment):
+                current = target.get(parts[-1])
+                target[parts[-1]] = (current if isinstance(current, (int, float)) else 0) + value.value
+            elif isinstance(value, ArrayUnion):
+                current = list(target.get(parts[-1]) or [])
+                target[parts[-1]] = current + [item for item in value.values if item not in current]
+            elif isinstance(value, ArrayRemove):
+                current = target.get(parts[-1])
+                target[parts[-1]] = [item for item in (current if isinstance(current, list) else []) if item not in value.values]
+            elif isinstance(value, dict):
+                # copied rather than changed in place, it can be shared with the stored document
+                target[parts[-1]] = dict(target[parts[-1]]) if merge and isinstance(target.get(parts[-1]), dict) else {}
+                MemoryClient._apply(target[parts[-1]], value, merge=True)
+            else:
+                target[parts[-1]] = copy.deepcopy(value)
+        return data
+
+    def _listen(self, path, callback, filters=()):
+        with self._lock:
+            listener = SimpleNamespace(callback=callback, filters=filters)
+            self._listeners.setdefault(path, []).append(listener)
+            read_time = self._now()
+            snapshots = self._listenerDocuments(path, filters, read_time)
+            callback(snapshots, [SimpleNamespace(type=SimpleNamespace(name='ADDED'), document=snapshot) for snapshot in snapshots], read_time)
+        return SimpleNamespace(unsubscribe=lambda: self._listeners[path].remove(listener))
+
+    def _listenerDocuments(self, path, filters, read_time):
+        return [
+            self._snapshot(MemoryDocument(self, path + (document_id,)), stored, read_time)
+            for document_id, stored in self._collections.get(path, {}).items() if _passes(filters, document_id, stored.data)
+        ]
+
+    # Called with the lock held after a commit, sends the changed documents of each collection to the listeners
+    # whose filters they match. Removed documents are matched on their id only.
+    def _notify(self, changes, read_time):
+        for path, collection_changes in changes.items():
+            for listener in list(self._listeners.get(path, ())):
+                snapshot_changes = [
+                    SimpleNamespace(type=SimpleNamespace(name=change), document=self._snapshot(MemoryDocument(self, document_path), stored, read_time) if stored else DocumentSnapshot(MemoryDocument(self, document_path), None, exists=False, read_time=read_time, create_time=None, update_time=None))
+                    for change, document_path, stored in collection_changes
+                    if _passes([flt for flt in listener.filters if stored or flt[0] == DOCUMENT_ID], document_path[-1], stored.data if stored else {})
+                ]
+                if snapshot_changes:
+                    listener.callback(self._listenerDocuments(path, listener.filters, read_time), snapshot_changes, read_time)
@@ -0,0 +1,124 @@
+import contextvars
+import os
+import time
+import jinja2
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+# Requests slower than this many seconds are logged with their Firestore usage
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 1))
+
+REQUEST_SECONDS = Histogram('booking_request_seconds', "Time to handle a request", ['method', 'route'])
+FIRESTORE_RPCS = Counter('booking_firestore_rpcs_total', "Firestore round trips", ['route', 'rpc'])
+FIRESTORE_RPC_SECONDS = Histogram('booking_firestore_rpc_seconds', "Latency of Firestore round trips, until the last streamed document", ['route', 'rpc'])
+FIRESTORE_DOCUMENTS_READ = Counter('booking_firestore_documents_read_total', "Documents returned by Firestore reads and queries", ['route'])
+FIRESTORE_WRITES = Counter('booking_firestore_writes_total', "Documents written in Firestore commits", ['route'])
+TOKEN_VERIFICATION_SECONDS = Histogram('booking_token_verification_seconds', "Time to verify the login token of a request", ['route'])
+TEMPLATE_RENDER_SECONDS = Histogram('booking_template_render_seconds', "Time to render a page template", ['template'])
+ADMISSION_RUNNING = Gauge('booking_admission_running', "Requests admitted by the concurrency limiter and still running")
+ADMISSION_QUEUED = Gauge('booking_admission_queued', "Requests waiting for the concurrency limiter", ['priority'])
+ADMISSION_WAIT_SECONDS = Histogram('booking_admission_wait_seconds', "Time requests waited for the concurrency limiter", ['priority'])
+ADMISSION_SHED = Counter('booking_admission_shed_total', "Requests turned away by the concurrency limiter", ['route', 'reason'])
+
+class RequestStats:
+    """What one request spent, collected while it runs and recorded under its route when it finishes."""
+
+    def __init__(self):
+        self.rpcs = []
+        self.documents = 0
+        self.writes = 0
+        self.token_seconds = 0.0
+        self.render_seconds = 0.0
+        self.queue_seconds = 0.0
+
+# Stats of the request being handled, None outside of requests (startup, background tasks)
+_request_stats = contextvars.ContextVar('request_stats', default=None)
+
+# Function to record a Firestore round trip, called by the instrumented client (see storage.py)
+def recordRpc(rpc, seconds, documents=0, writes=0):
+    stats = _request_stats.get()
+    if stats is None:
+        FIRESTORE_RPCS.labels('none', rpc).inc()
+        FIRESTORE_RPC_SECONDS.labels('none', rpc).observe(seconds)
+        FIRESTORE_DOCUMENTS_READ.labels('none').inc(documents)
+        FIRESTORE_WRITES.labels('none').inc(writes)
+        return
+    stats.rpcs.append((rpc, seconds))
+    stats.documents += documents
+    stats.writes += writes
+
+# Function to record how long the request waited for the concurrency limiter (see admission.py)
+def recordQueueWait(priority, seconds):
+    ADMISSION_WAIT_SECONDS.labels(priority).observe(seconds)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queue_seconds += seconds
+
+def recordTokenVerification(seconds):
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.token_seconds += seconds
+
+class TimedTemplate(jinja2.Template):
+    """Jinja2 template class that records how long every render takes, set as the environment's template_class."""
+
+    def render(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - started
+            TEMPLATE_RENDER_SECONDS.labels(self.name).observe(seconds)
+            stats = _request_stats.get()
+            if stats is not None:
+                stats.render_seconds += seconds
+
+# Function to call `callback` once the body of a response returned by call_next has been sent, or the client went away.
+# Middleware gets the response as soon as its headers are ready, streamed bodies (the exports) are still being read
+# from Firestore after that.
+def afterBody(response, callback):
+    body = response.body_iterator
+
+    async def stream():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            callback()
+    response.body_iterator = stream()
+    return response
+
+# Function to record what a request spent under its route, once its response was sent
+def _recordRequest(request, stats, started):
+    seconds = time.perf_counter() - started
+    # the route template rather than the path, so there is one series per handler
+    route = getattr(request.scope.get('route'), 'path', 'unmatched')
+    REQUEST_SECONDS.labels(request.method, route).observe(seconds)
+    for rpc, rpc_seconds in stats.rpcs:
+        FIRESTORE_RPCS.labels(route, rpc).inc()
+        FIRESTORE_RPC_SECONDS.labels(route, rpc).observe(rpc_seconds)
+    FIRESTORE_DOCUMENTS_READ.labels(route).inc(stats.documents)
+    FIRESTORE_WRITES.labels(route).inc(stats.writes)
+    if stats.token_seconds:
+        TOKEN_VERIFICATION_SECONDS.labels(route).observe(stats.token_seconds)
+    if seconds >= SLOW_REQUEST_SECONDS:
+        print(f"Slow request: {request.method} {request.url.path} took {seconds * 1000:.0f} ms, "
+              f"{len(stats.rpcs)} Firestore RPCs ({sum(rpc_seconds for rpc, rpc_seconds in stats.rpcs) * 1000:.0f} ms), "
+              f"{stats.documents} documents read, {stats.writes} writes, "
+              f"queued {stats.queue_seconds * 1000:.0f} ms, token {stats.token_seconds * 1000:.0f} ms, templates {stats.render_seconds * 1000:.0f} ms")
+
+# Middleware timing every request and recording its Firestore usage under the route that handled it. Requests are
+# recorded when their body has been sent, so the round trips of streamed bodies and the time they take are included.
+async def instrumentRequest(request, call_next):
+    stats = RequestStats()
+    _request_stats.set(stats)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    except BaseException:
+        _recordRequest(request, stats, started)
+        raise
+    return afterBody(response, lambda: _recordRequest(request, stats, started))
+
+# Function to get the metrics in the Prometheus text format, with its content type
+def exposition():
+    return generate_latest(), CONTENT_TYPE_LATEST
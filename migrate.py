@@ -0,0 +1,181 @@
+"""One-off data migrations, run from the command line against the configured Firestore project.
+
+    python migrate.py day-ids
+    python migrate.py booking-documents
+    python migrate.py booking-index
+    python migrate.py usernames
+    python migrate.py room-stats
+    python migrate.py calendar-keys
+"""
+import argparse
+import asyncio
+from google.cloud import firestore
+from database import firestore_db, bookingIndex, bookingKey, bookingRef, bookingData
+from intervals import DaySchedule
+from roomstats import dayStats, statsRef
+from feeds import newCalendarKey
+
+# Firestore rejects batches with more writes than this
+BATCH_SIZE = 500
+
+class ChunkedBatch:
+    """A write batch that commits itself every BATCH_SIZE writes, writes are committed in the order they are added."""
+
+    def __init__(self):
+        self._batch = firestore_db.batch()
+        self._writes = 0
+        self.total = 0
+
+    async def _added(self):
+        self._writes += 1
+        self.total += 1
+        if self._writes == BATCH_SIZE:
+            await self.commit()
+
+    async def set(self, reference, data):
+        self._batch.set(reference, data)
+        await self._added()
+
+    async def update(self, reference, data):
+        self._batch.update(reference, data)
+        await self._added()
+
+    async def delete(self, reference):
+        self._batch.delete(reference)
+        await self._added()
+
+    async def commit(self):
+        if self._writes:
+            await self._batch.commit()
+        self._batch = firestore_db.batch()
+        self._writes = 0
+
+# Bookings used to be kept in a `bookings` array on one document per room and date, in the days collection.
+# The migrations of those documents use these helpers.
+def dayKey(room_id, date):
+    return f"{room_id}_{date}"
+
+def dayRef(room_id, date):
+    return firestore_db.collection('days').document(dayKey(room_id, date))
+
+async def getDays():
+    return [day async for day in firestore_db.collection('days').stream()]
+
+async def backfillBookingIndex():
+    """Mirror every existing booking into the per-user bookings index."""
+    batch = ChunkedBatch()
+    async for booking in firestore_db.collection('bookings').stream():
+        data = booking.to_dict()
+        await batch.set(bookingIndex(data['user']).document(booking.id), data)
+    await batch.commit()
+    print(f"Indexed {batch.total} bookings")
+
+async def addCalendarKeys():
+    """Give every room without one the key its calendar feed URL needs."""
+    batch = ChunkedBatch()
+    async for room in firestore_db.collection('rooms').stream():
+        if not room.to_dict().get('calendar_key'):
+            await batch.update(room.reference, {'calendar_key': newCalendarKey()})
+    await batch.commit()
+    print(f"Added the calendar keys of {batch.total} rooms")
+
+async def computeRoomStats():
+    """Write the daily stats of every room from its bookings.
+
+    The stats are written whole rather than incremented, so the migration can be run again to correct
+    them, for instance if bookings were made while it ran.
+    """
+    batch = ChunkedBatch()
+    bookings = {}
+    async for booking in firestore_db.collection('bookings').select(['room_id', 'date', 'from', 'to']).stream():
+        bookings.setdefault(booking.get('room_id'), []).append(booking.to_dict())
+    for room_id, room_bookings in bookings.items():
+        for date, stats in dayStats(room_bookings).items():
+            await batch.set(statsRef(room_id, date), dict(stats, room_id=room_id, date=date))
+    await batch.commit()
+    print(f"Wrote the stats of {batch.total} days")
+
+async def reserveUsernames():
+    """Create the usernames/{name} reservation of every user's username.
+
+    Usernames used to be checked with a query, so two users may have picked the same one. The first
+    user by id (the order users are streamed in) keeps the reservation and the others are listed, they are asked for a new name the
+    next time they set one.
+    """
+    batch = ChunkedBatch()
+    owners = {}
+    async for reservation in firestore_db.collection('usernames').stream():
+        owners[reservation.id] = reservation.get('user_id')
+    async for user in firestore_db.collection('users').stream():
+        name = user.to_dict().get('username')
+        if not name:
+            continue
+        if name in owners:
+            if owners[name] != user.id:
+                print(f"Username {name!r} of user {user.id} is already held by user {owners[name]}")
+            continue
+        owners[name] = user.id
+        await batch.set(firestore_db.collection('usernames').document(name), {'user_id': user.id})
+    await batch.commit()
+    print(f"Reserved {batch.total} usernames")
+
+async def splitDays():
+    """Move the bookings of every day document to booking documents of their own and delete the day documents.
+
+    The bookings are indexed for their users on the way. Everything is written before the days are
+    deleted, so an interrupted run can simply be started again.
+    """
+    batch = ChunkedBatch()
+    days = await getDays()
+    for day in days:
+        for booking in day.get('bookings') or []:
+            await batch.set(bookingRef(day.get('room_id'), booking), bookingData(day.get('room_id'), booking))
+            await batch.set(bookingIndex(booking['user']).document(bookingKey(day.get('room_id'), booking)), bookingData(day.get('room_id'), booking))
+    await batch.commit()
+    for day in days:
+        await batch.delete(day.reference)
+    await batch.commit()
+    print(f"Made {batch.total} writes")
+
+async def rekeyDays():
+    """Move day documents to "<room id>_<date>" ids and drop the days arrays of the rooms.
+
+    Days of the same room and date are merged. The new documents are written before the old ones
+    are deleted, so an interrupted run can simply be started again.
+    """
+    batch = ChunkedBatch()
+    async for room in firestore_db.collection('rooms').stream():
+        days = room.to_dict().get('days') or []
+        bookings = {}
+        old_days = []
+        if days:
+            async for day in firestore_db.get_all(days):
+                if not day.exists:
+                    continue
+                bookings.setdefault(day.get('date'), []).extend(day.get('bookings'))
+                if day.id != dayKey(room.id, day.get('date')):
+                    old_days.append(day.reference)
+
+        for date, day_bookings in bookings.items():
+            await batch.set(dayRef(room.id, date), {'date': date, 'room': room.get('name'), 'room_id': room.id, 'bookings': DaySchedule(day_bookings).bookings()})
+        await batch.commit()
+        for day in old_days:
+            await batch.delete(day)
+        await batch.update(room.reference, {'days': firestore.DELETE_FIELD})
+    await batch.commit()
+    print(f"Made {batch.total} writes")
+
+MIGRATIONS = {
+    'day-ids': rekeyDays,
+    'booking-documents': splitDays,
+    'booking-index': backfillBookingIndex,
+    'usernames': reserveUsernames,
+    'room-stats': computeRoomStats,
+    'calendar-keys': addCalendarKeys,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('migration', choices=MIGRATIONS)
+    args = parser.parse_args()
+    asyncio.run(MIGRATIONS[args.migration]())
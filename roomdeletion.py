@@ -0,0 +1,114 @@
+import asyncio
+import contextvars
+import datetime
+from google.cloud.firestore_v1.transforms import ArrayRemove
+from database import firestore_db, bookingIndex, roomBookingsQuery
+from catalog import room_catalog
+from booking import RoomNotFound
+from storage import bulkWriter, transactional, runTransaction, TransactionAborted
+from versions import roomChanged
+from roomstats import roomStatsQuery
+
+# Bookings deleted per round of a deletion job, the job's progress is saved after every round
+PAGE_SIZE = 500
+
+class RoomHasBookings(Exception):
+    """Raised when a room that still has upcoming bookings is deleted."""
+
+class RoomDeletionAborted(Exception):
+    """Raised when a room could not be deleted in MAX_ATTEMPTS because of contention on it."""
+
+# Running jobs, so they are not garbage collected before they finish
+_tasks = set()
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+
+# Status documents of deletion jobs, room_deletions/{job id}. They are kept in Firestore so any instance can report them.
+def deletionRef(job_id=None):
+    return firestore_db.collection('room_deletions').document(job_id)
+
+# Function run (and re-run on contention) inside the transaction deleting a room. The room is read and its upcoming
+# bookings are checked in the same transaction as the room is deleted, so a booking made in the meantime either makes
+# the check fail or finds the room gone (bookings read the room in their own transaction).
+@transactional
+async def _deleteRoom(transaction, room_ref, user_ref, job_ref, job):
+    today = datetime.date.today().isoformat()
+    room = await room_ref.get(transaction=transaction)
+    if not room.exists:
+        raise RoomNotFound("The selected room is no longer available")
+    if [booking async for booking in roomBookingsQuery(room_ref.id, today).limit(1).stream(transaction=transaction)]:
+        raise RoomHasBookings('Cannot delete room with upcoming bookings')
+    transaction.delete(room_ref)
+    transaction.update(user_ref, {'rooms_list': ArrayRemove([room_ref])})
+    transaction.create(job_ref, job)
+
+async def startRoomDeletion(room, user):
+    """Delete a room, the past bookings on it are deleted by a job running in the background.
+
+    Raises RoomHasBookings if the room has bookings from today on, which is checked with a query
+    that reads at most one booking, RoomNotFound if it is already gone and RoomDeletionAborted if
+    the transaction kept colliding with other writers. The room document, its removal from the
+    user's list of rooms and the job's status document are written in the same transaction, so the
+    room is gone for everyone as soon as this returns. The job then deletes the bookings, their
+    index entries and the room's stats with a bulk writer. Returns the job's status, which can be
+    polled with getRoomDeletion.
+    """
+    job_ref = deletionRef()
+    job = {'room': room.name, 'room_id': room.id, 'user_id': user.id, 'status': 'running', 'deleted': 0, 'started': _now(), 'finished': None, 'error': None}
+    try:
+        await runTransaction(firestore_db, _deleteRoom, firestore_db.collection('rooms').document(room.id), user.reference, job_ref, job)
+    except TransactionAborted as err:
+        raise RoomDeletionAborted(str(err))
+    room_catalog.remove(room.id)
+    roomChanged(room.id)
+
+    # the job runs in an empty context, so its round trips are not accounted to the request that started it
+    task = contextvars.Context().run(asyncio.create_task, _deleteBookings(job_ref, room.id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return dict(job, id=job_ref.id)
+
+# Function to get the status of a deletion job started by the user, None if there is no such job
+async def getRoomDeletion(job_id, user_id):
+    job = await deletionRef(job_id).get()
+    if not job.exists or job.get('user_id') != user_id:
+        return None
+    return dict(job.to_dict(), id=job.id)
+
+# Function run by the worker thread to delete documents with the bulk writer, which blocks while it sends them
+def _deleteAll(writer, references):
+    for reference in references:
+        writer.delete(reference)
+    writer.flush()
+
+# Function run in the background to delete every booking of a deleted room with its index entry, page by page,
+# and then the room's daily stats
+async def _deleteBookings(job_ref, room_id):
+    writer = bulkWriter()
+    deleted = 0
+    query = roomBookingsQuery(room_id).select(['user']).limit(PAGE_SIZE)
+    try:
+        page = [booking async for booking in query.stream()]
+        while page:
+            references = [booking.reference for booking in page] + [bookingIndex(booking.get('user')).document(booking.id) for booking in page]
+            await asyncio.to_thread(_deleteAll, writer, references)
+            deleted += len(page)
+            await job_ref.update({'deleted': deleted})
+            if len(page) < PAGE_SIZE:
+                break
+            page = [booking async for booking in query.start_after(page[-1]).stream()]
+        query = roomStatsQuery(room_id).select(['date']).limit(PAGE_SIZE)
+        page = [day async for day in query.stream()]
+        while page:
+            await asyncio.to_thread(_deleteAll, writer, [day.reference for day in page])
+            if len(page) < PAGE_SIZE:
+                break
+            page = [day async for day in query.start_after(page[-1]).stream()]
+        await job_ref.update({'status': 'done', 'finished': _now()})
+    except Exception as err:
+        print(f"Deleting the bookings of room {room_id} failed: {err}")
+        await job_ref.update({'status': 'failed', 'finished': _now(), 'error': str(err)})
+    finally:
+        await asyncio.to_thread(writer.close)
+    roomChanged(room_id)
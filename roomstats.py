@@ -0,0 +1,104 @@
+import datetime
+from collections import Counter
+import numpy as np
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.cloud.firestore_v1.transforms import Increment
+from database import firestore_db
+from intervals import toMinutes
+
+# Periods the stats of a room can be rolled up to
+PERIODS = ('day', 'week', 'month')
+
+# Most days the stats of a room can be asked for at once, each one is a document read
+MAX_STATS_DAYS = 731
+
+# Daily stats of the rooms, room_stats/{room id}_{date}: the number of bookings, the minutes booked and the minutes
+# booked in every hour of the day (by "00" to "23"). They are kept up to date in the writes of the bookings, so
+# reports read one small document per room and day instead of the bookings.
+def statsKey(room_id, date):
+    return f"{room_id}_{date}"
+
+def statsRef(room_id, date):
+    return firestore_db.collection('room_stats').document(statsKey(room_id, date))
+
+# Query for the daily stats of a room, optionally only from the `start` to the `end` date (inclusive), ordered by date
+def roomStatsQuery(room_id, start=None, end=None):
+    stats = firestore_db.collection('room_stats')
+    query = stats.where(filter=FieldFilter(FieldPath.document_id(), '>=', stats.document(statsKey(room_id, start) if start else f"{room_id}_")))
+    return query.where(filter=FieldFilter(FieldPath.document_id(), '<=' if end else '<', stats.document(statsKey(room_id, end) if end else f"{room_id}`")))
+
+# Function to split the minutes of a booking between the hours of the day it covers
+def _hourMinutes(booking):
+    start, end = toMinutes(booking['from']), toMinutes(booking['to'])
+    return {f"{hour:02d}": min(end, (hour + 1) * 60) - max(start, hour * 60) for hour in range(start // 60, (end + 59) // 60)}
+
+# Function to sum up bookings by date, returns the stats of every date
+def dayStats(bookings):
+    days = {}
+    for booking in bookings:
+        day = days.setdefault(booking['date'], {'bookings': 0, 'minutes': 0, 'hours': Counter()})
+        hours = _hourMinutes(booking)
+        day['bookings'] += 1
+        day['minutes'] += sum(hours.values())
+        day['hours'].update(hours)
+    return {date: dict(day, hours=dict(day['hours'])) for date, day in days.items()}
+
+# Function to add bookings of a room to the stats of their days, or take them out with sign=-1, in a batch or transaction.
+# The stats are changed with increments, one write per day, so they are never read and don't make the transaction
+# conflict with other bookings on the same day.
+def countBookings(batch, room_id, bookings, sign=1):
+    for date, day in dayStats(bookings).items():
+        batch.set(statsRef(room_id, date), {
+            'room_id': room_id,
+            'date': date,
+            'bookings': Increment(sign * day['bookings']),
+            'minutes': Increment(sign * day['minutes']),
+            'hours': {hour: Increment(sign * minutes) for hour, minutes in day['hours'].items()},
+        }, merge=True)
+
+# Function to get the first day of the period a date is in, weeks start on Mondays
+def _periodStart(date, period):
+    if period == 'week':
+        return date - datetime.timedelta(days=date.weekday())
+    if period == 'month':
+        return date.replace(day=1)
+    return date
+
+# Function to roll the daily stats of a room up to every period from the `start` to the `end` date, periods without
+# stats included. The hours of the busiest hour are the peak, None when nothing was booked.
+def rollUp(days, period, start, end):
+    periods = []
+    date = _periodStart(start, period)
+    while date <= end:
+        periods.append(date.toordinal())
+        date = date.replace(month=date.month % 12 + 1, year=date.year + date.month // 12) if period == 'month' else date + datetime.timedelta(days=7 if period == 'week' else 1)
+
+    # one row per day: bookings, minutes, then the minutes of every hour
+    values = np.zeros((len(days), 26), dtype=np.int64)
+    for row, day in enumerate(days):
+        values[row, 0] = day.get('bookings', 0)
+        values[row, 1] = day.get('minutes', 0)
+        for hour, minutes in (day.get('hours') or {}).items():
+            values[row, 2 + int(hour)] = minutes
+    rows = np.searchsorted(periods, [_periodStart(datetime.date.fromisoformat(day['date']), period).toordinal() for day in days])
+    totals = np.zeros((len(periods), 26), dtype=np.int64)
+    np.add.at(totals, rows, values)
+
+    hours = totals[:, 2:]
+    peaks = np.where(hours.max(axis=1) > 0, hours.argmax(axis=1), -1)
+    return [
+        {
+            'start': datetime.date.fromordinal(ordinal).isoformat(),
+            'bookings': int(total[0]),
+            'minutes': int(total[1]),
+            'peak_hour': f"{peak:02d}:00" if peak >= 0 else None,
+            'hours': total[2:].tolist(),
+        }
+        for ordinal, total, peak in zip(periods, totals, peaks)
+    ]
+
+# Function to get the stats of a room from the `start` to the `end` date (inclusive, datetime.date) per day, week or month
+async def getRoomStats(room_id, start, end, period):
+    days = [day.to_dict() async for day in roomStatsQuery(room_id, start.isoformat(), end.isoformat()).stream()]
+    return rollUp(days, period, start, end)
@@ -1,14 +1,125 @@
 'use strict';
 
-document.getElementById("add-room").addEventListener("click", function(){
-    document.getElementById("add-form").hidden = false;
-    document.getElementById("list-of-rooms").hidden = true;
-    document.getElementById("list-of-bookings-all-rooms").hidden = true;
-    document.getElementById("list-of-bookings-one-room").hidden = true;
-    document.getElementById("list-of-bookings-filtered-by-day").hidden = true;
-})
-
-document.getElementById("list-of-rooms").hidden = false;
-document.getElementById("list-of-bookings-all-rooms").hidden = false;
-document.getElementById("list-of-bookings-one-room").hidden = false;
-document.getElementById("list-of-bookings-filtered-by-day").hidden = false;
\ No newline at end of file
+// Function to show or hide an element, pages only have some of the sections
+function setHidden(id, hidden) {
+    const element = document.getElementById(id);
+    if (element) {
+        element.hidden = hidden;
+    }
+}
+
+const addRoom = document.getElementById("add-room");
+if (addRoom) {
+    addRoom.addEventListener("click", function(){
+        setHidden("add-form", false);
+        setHidden("list-of-rooms", true);
+        setHidden("list-of-bookings-all-rooms", true);
+        setHidden("list-of-bookings-one-room", true);
+        setHidden("list-of-bookings-filtered-by-day", true);
+    })
+}
+
+setHidden("list-of-rooms", false);
+setHidden("list-of-bookings-all-rooms", false);
+setHidden("list-of-bookings-one-room", false);
+setHidden("list-of-bookings-filtered-by-day", false);
+
+// Function to listen to the server-sent events of a page, the server asks for a reload when it had to drop changes
+function listen(url, handlers) {
+    const source = new EventSource(url);
+    for (const [event, handler] of Object.entries(handlers)) {
+        source.addEventListener(event, function(message){
+            handler(JSON.parse(message.data));
+        })
+    }
+    source.addEventListener("reload", function(){
+        window.location.reload();
+    })
+}
+
+// Function to insert an element among its siblings, which are sorted by `key`
+function insertSorted(parent, element, key) {
+    const next = Array.from(parent.children).find(function(child){
+        return key(child) > key(element);
+    });
+    parent.insertBefore(element, next || null);
+}
+
+// Room list of the main page, rooms added and removed anywhere show up without reloading
+const roomList = document.getElementById("room-list");
+if (roomList) {
+    const roomItem = document.getElementById("room-item");
+    listen(roomList.dataset.live, {
+        rooms: function(change){
+            for (const name of change.removed) {
+                for (const item of roomList.querySelectorAll("li[data-room]")) {
+                    if (item.dataset.room === name) {
+                        item.remove();
+                    }
+                }
+            }
+            for (const name of change.added) {
+                const item = roomItem.content.firstElementChild.cloneNode(true);
+                item.dataset.room = name;
+                const link = item.querySelector("a");
+                link.href = "/view-room/" + encodeURIComponent(name);
+                link.textContent = name;
+                for (const input of item.querySelectorAll("input[type=hidden]")) {
+                    input.value = name;
+                }
+                insertSorted(roomList, item, function(child){ return child.dataset.room; });
+            }
+        },
+    });
+}
+
+// Bookings table of a room page, with one list per day and one item per booking, both sorted
+const roomDetails = document.getElementById("rooms-details");
+const roomBookings = document.getElementById("room-bookings");
+if (roomDetails && roomBookings) {
+    listen(roomDetails.dataset.live, {
+        bookings: function(change){
+            let day = roomBookings.querySelector(`ul[data-date="${change.date}"]`);
+            for (const booking of change.removed) {
+                if (day) {
+                    const item = day.querySelector(`ul[data-from="${booking.from}"]`);
+                    if (item) {
+                        item.remove();
+                    }
+                }
+            }
+            if (change.added.length && !day) {
+                day = document.createElement("ul");
+                day.dataset.date = change.date;
+                const dayItem = document.createElement("li");
+                dayItem.style.margin = "5px auto";
+                const title = document.createElement("p");
+                title.textContent = `On ${change.date}:`;
+                dayItem.appendChild(title);
+                day.appendChild(dayItem);
+                const days = Array.from(roomBookings.querySelectorAll("ul[data-date]"));
+                const next = days.find(function(other){ return other.dataset.date > change.date; });
+                roomBookings.insertBefore(day, next || document.getElementById("room-bookings-empty"));
+            }
+            for (const booking of change.added) {
+                const list = document.createElement("ul");
+                list.dataset.from = booking.from;
+                list.dataset.to = booking.to;
+                const item = document.createElement("li");
+                item.style.margin = "5px auto";
+                item.textContent = `${booking.name} from ${booking.from} to ${booking.to}`;
+                list.appendChild(item);
+                const dayItem = day.firstElementChild;
+                const next = Array.from(dayItem.querySelectorAll("ul[data-from]")).find(function(other){ return other.dataset.from > booking.from; });
+                dayItem.insertBefore(list, next || null);
+            }
+            // days without bookings are not shown
+            if (day && !day.querySelector("ul[data-from]")) {
+                day.remove();
+            }
+            const empty = !roomBookings.querySelector("ul[data-date]");
+            setHidden("room-bookings-title", empty);
+            setHidden("room-bookings-empty", !empty);
+        },
+    });
+}
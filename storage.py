@@ -0,0 +1,111 @@
+import os
+import time
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_transaction import _EXCEED_ATTEMPTS_TEMPLATE
+from metrics import recordRpc
+
+# Where the data is kept, set with the BOOKING_STORAGE environment variable:
+#   firestore  the configured Firestore project (the default)
+#   memory     an in-process store with the same semantics, see memorydb.py. It needs no GCP credentials or
+#              network, so the app can be run, load tested and profiled locally and in CI. BOOKING_STORAGE_LATENCY
+#              adds a delay in milliseconds to every round trip to mimic the network.
+STORAGE = os.environ.get('BOOKING_STORAGE', 'firestore')
+
+# Number of times a transaction is attempted when it keeps colliding with other writers
+MAX_ATTEMPTS = 5
+
+class TransactionAborted(Exception):
+    """Raised when a transaction could not be committed in MAX_ATTEMPTS because of contention."""
+
+# Function to run a @transactional function in a new transaction of `client`, raises TransactionAborted once it ran
+# out of attempts. The clients raise ValueError for that, so only their own message is turned into TransactionAborted
+# and the errors of the function itself, ValueError included, go through unchanged.
+async def runTransaction(client, function, *args):
+    try:
+        return await function(client.transaction(max_attempts=MAX_ATTEMPTS), *args)
+    except ValueError as err:
+        if str(err) != _EXCEED_ATTEMPTS_TEMPLATE.format(MAX_ATTEMPTS):
+            raise
+        raise TransactionAborted(str(err))
+
+if STORAGE == 'memory':
+    from memorydb import MemoryClient, transactional
+
+    _client = MemoryClient(latency=float(os.environ.get('BOOKING_STORAGE_LATENCY', 0)) / 1000, on_rpc=recordRpc)
+
+    def asyncClient():
+        return _client
+
+    # Client for snapshot listeners
+    def listenerClient():
+        return _client
+
+    # Bulk writer for deleting or writing many documents, see the Firestore version below
+    def bulkWriter():
+        return _client.bulk_writer()
+
+elif STORAGE == 'firestore':
+    transactional = firestore.async_transactional
+
+    # Functions wrapping the RPCs of the client's API layer, so every round trip is recorded with its latency,
+    # the documents it streamed back and the documents it wrote, whichever client method issued it
+    def _streamedRpc(rpc, method, field):
+        async def call(*args, **kwargs):
+            started = time.perf_counter()
+            responses = await method(*args, **kwargs)
+
+            async def stream():
+                documents = 0
+                try:
+                    async for response in responses:
+                        if field in response:
+                            documents += 1
+                        yield response
+                finally:
+                    recordRpc(rpc, time.perf_counter() - started, documents=documents)
+            return stream()
+        return call
+
+    def _unaryRpc(rpc, method):
+        async def call(*args, request=None, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await method(*args, request=request, **kwargs)
+            finally:
+                writes = len(request.get('writes') or []) if isinstance(request, dict) else 0
+                recordRpc(rpc, time.perf_counter() - started, writes=writes)
+        return call
+
+    def _blockingRpc(rpc, method):
+        def call(*args, request=None, **kwargs):
+            started = time.perf_counter()
+            try:
+                return method(*args, request=request, **kwargs)
+            finally:
+                writes = len(request.get('writes') or []) if isinstance(request, dict) else 0
+                recordRpc(rpc, time.perf_counter() - started, writes=writes)
+        return call
+
+    def asyncClient():
+        client = firestore.AsyncClient()
+        api = client._firestore_api
+        api.batch_get_documents = _streamedRpc('get', api.batch_get_documents, 'found')
+        api.run_query = _streamedRpc('query', api.run_query, 'document')
+        for rpc in ('commit', 'begin_transaction', 'rollback'):
+            setattr(api, rpc, _unaryRpc(rpc, getattr(api, rpc)))
+        return client
+
+    # Client for snapshot listeners, the async client does not support them
+    def listenerClient():
+        return firestore.Client()
+
+    # Bulk writer for deleting or writing many documents. BulkWriter is synchronous (its methods block the
+    # calling thread, so call them from a worker thread) and sends its batches from its own threads, so it
+    # gets a sync client, whose batch writes are recorded like the round trips of the async client.
+    def bulkWriter():
+        client = firestore.Client()
+        client._firestore_api.batch_write = _blockingRpc('batch_write', client._firestore_api.batch_write)
+        return client.bulk_writer()
+
+else:
+    raise ValueError(f"Unknown BOOKING_STORAGE {STORAGE!r}, use 'firestore' or 'memory'")
@@ -0,0 +1,91 @@
+import time
+from collections import OrderedDict
+from storage import transactional, runTransaction, TransactionAborted
+from database import firestore_db
+
+# Names known to be taken that are kept in memory, and for how long. A name is only freed when its owner
+# picks another one, possibly through another instance, so entries don't live forever.
+TAKEN_CACHE_SIZE = 10000
+TAKEN_CACHE_SECONDS = 600
+
+class UsernameTaken(Exception):
+    """Raised when the username is claimed by another user."""
+
+class UsernameAborted(Exception):
+    """Raised when the username could not be claimed in MAX_ATTEMPTS because of contention."""
+
+# Owners of the names known to be taken, with when the entry expires, least recently added first
+_taken = OrderedDict()
+
+def _cachedOwner(name):
+    entry = _taken.get(name)
+    if entry is None:
+        return None
+    if entry[1] < time.monotonic():
+        del _taken[name]
+        return None
+    return entry[0]
+
+def _cacheOwner(name, user_id):
+    _taken[name] = (user_id, time.monotonic() + TAKEN_CACHE_SECONDS)
+    _taken.move_to_end(name)
+    while len(_taken) > TAKEN_CACHE_SIZE:
+        _taken.popitem(last=False)
+
+# Usernames are claimed by reservation documents, usernames/{name} with the id of the user who holds the name,
+# so checking a name is one document read instead of a query on the users collection
+def usernameRef(name):
+    return firestore_db.collection('usernames').document(name)
+
+# Function to check a username can be used, returns the error message to show or None if it can.
+# Names are document ids, which can't contain slashes and can't be "." or "..".
+def validateUsername(name):
+    if not name.strip():
+        return 'Enter a username.'
+    if '/' in name or name in ('.', '..') or (name.startswith('__') and name.endswith('__')):
+        return 'This username is not allowed.'
+    if len(name) > 100:
+        return 'This username is too long.'
+    return None
+
+# Function run (and re-run on contention) inside the transaction. The reservation is created and the user updated
+# together, so two users can't both get the same name, and the user's previous name is released. Returns the
+# previous name, or the new one if the user already had it.
+@transactional
+async def _reserveUsername(transaction, user_ref, name):
+    # get_all doesn't keep the order of the references
+    snapshots = {snapshot.reference.path: snapshot async for snapshot in firestore_db.get_all([usernameRef(name), user_ref], transaction=transaction)}
+    reservation, user = snapshots[usernameRef(name).path], snapshots[user_ref.path]
+    if reservation.exists:
+        if reservation.get('user_id') != user_ref.id:
+            raise UsernameTaken(reservation.get('user_id'))
+        return name
+
+    previous = user.get('username') if user.exists else ''
+    if previous:
+        # users who picked their name before reservations existed may not hold one
+        previous_reservation = await usernameRef(previous).get(transaction=transaction)
+        if previous_reservation.exists and previous_reservation.get('user_id') == user_ref.id:
+            transaction.delete(previous_reservation.reference)
+    transaction.create(usernameRef(name), {'user_id': user_ref.id})
+    transaction.update(user_ref, {'username': name})
+    return previous
+
+# Function to give a user a username, raises UsernameTaken or UsernameAborted if it can't.
+# Repeated attempts at a name known to be taken are answered from memory.
+async def claimUsername(user_ref, name):
+    owner = _cachedOwner(name)
+    if owner == user_ref.id:
+        return
+    if owner is not None:
+        raise UsernameTaken(owner)
+
+    try:
+        previous = await runTransaction(firestore_db, _reserveUsername, user_ref, name)
+    except UsernameTaken as err:
+        _cacheOwner(name, err.args[0])
+        raise
+    except TransactionAborted as err:
+        raise UsernameAborted(str(err))
+    _taken.pop(previous, None)
+    _cacheOwner(name, user_ref.id)
@@ -0,0 +1,13 @@
+from collections import Counter
+
+# Version of the bookings of each room, bumped whenever this process writes bookings of the room: new bookings,
+# cancellations, imports and the deletion of the room. Anything rendered from a room's bookings (calendar feeds,
+# booking tables) is kept together with the version it was rendered at and is stale as soon as the version moved on.
+_room_versions = Counter()
+
+def roomVersion(room_id):
+    return _room_versions[room_id]
+
+# Function to call after bookings on a room were written
+def roomChanged(room_id):
+    _room_versions[room_id] += 1